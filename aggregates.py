@@ -0,0 +1,78 @@
+from collections import namedtuple
+
+all_provinces = 'All Provinces'
+all_regions = 'All Regions'
+
+# Counts for every (province, region) selection, built once per data load. Counts by date are in timeseries.py.
+#   agegender: {(prov, region): Series of counts by (sex, age_order)}, rows with neither reported excluded
+#   totals:    {(prov, region): number of rows}
+Cube = namedtuple('Cube', ['agegender', 'totals'])
+
+# Where each selection's rows are, built once per data load.
+#   provinces: sorted province names
+#   regions:   {prov: sorted region names}
+#   rows:      {(prov, region): ascending row positions}, including (prov, 'All Regions')
+GeoIndex = namedtuple('GeoIndex', ['provinces', 'regions', 'rows'])
+
+
+def selection_key(prov, region):
+    ''' Key into the cube tables for the dropdown values.'''
+    if prov == all_provinces or region is None:
+        region = all_regions
+    return prov, region
+
+
+def build_geo_index(frame):
+    ''' Row positions of every province and (province, region) in frame.'''
+    province = frame['province'].astype(object)
+    region = frame['health_region'].astype(object)
+    rows = {(prov, all_regions): positions for prov, positions in frame.groupby(province).indices.items()}
+    rows.update(frame.groupby([province, region]).indices)
+
+    regions = {}
+    for prov, reg in rows:
+        if reg != all_regions:
+            regions.setdefault(prov, []).append(reg)
+    regions = {prov: sorted(reg) for prov, reg in regions.items()}
+    return GeoIndex(sorted(prov for prov, reg in rows if reg == all_regions), regions, rows)
+
+
+def select_rows(frame, geo_index, prov, region):
+    ''' Rows of a selection, looked up in the frame's GeoIndex. All Provinces is the frame itself, not a copy.'''
+    if prov == all_provinces:
+        return frame
+    rows = geo_index.rows.get(selection_key(prov, region))
+    if rows is None:
+        return frame.iloc[:0]
+    return frame.iloc[rows]
+
+
+def _rollup(fine, extra_levels):
+    ''' Yield ((prov, region), counts) for every selection from counts indexed by (prov, region, *extra).'''
+    yield (all_provinces, all_regions), fine.groupby(level=extra_levels).sum()
+    for prov, counts in fine.groupby(level=0):
+        yield (prov, all_regions), counts.groupby(level=extra_levels).sum()
+    for (prov, region), counts in fine.groupby(level=[0, 1]):
+        if region != '':
+            yield (prov, region), counts.droplevel([0, 1])
+
+
+def build_cube(frame, id_col):
+    ''' Aggregate a case or death frame for every province/region selection.'''
+    # Missing geography still counts towards the broader totals
+    province = frame['province'].astype(object).fillna('').rename('province')
+    region = frame['health_region'].astype(object).fillna('').rename('health_region')
+
+    # age_order 0 is an unknown age group
+    reported = ~((frame['age'] == 'Not Reported') & (frame['sex'] == 'Not Reported')) & (frame['age_order'] > 0)
+    sub = frame[reported]
+    sex = sub['sex'].astype(object)
+    counts = sub.groupby([province[reported], region[reported], sex, sub['age_order']])[id_col].count()
+    agegender = {key: s[s > 0].unstack(fill_value=0).stack().sort_index()
+                 for key, s in _rollup(counts, [2, 3])}
+
+    sizes = frame.groupby([province, region]).size()
+    totals = {(all_provinces, all_regions): len(frame)}
+    totals.update({(prov, all_regions): int(n) for prov, n in sizes.groupby(level=0).sum().items()})
+    totals.update({(prov, region): int(n) for (prov, region), n in sizes.items() if region != ''})
+    return Cube(agegender, totals)
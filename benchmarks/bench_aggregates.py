@@ -0,0 +1,115 @@
+''' Per-callback latency of the old full-frame masking vs the aggregate cube and time series.
+
+Run from the repo root:  python benchmarks/bench_aggregates.py
+'''
+import os
+import sys
+from timeit import repeat
+import pandas as pd
+from numpy import nan
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from get_covid_data_from_url import get_covid_data
+from aggregates import build_cube, selection_key
+from timeseries import build_series, selection_window, province_window
+
+
+def as_before(frame):
+    ''' The frame layout before compact_frame: object text columns and NaN for unknown age_order.'''
+    frame = frame.astype({col: object for col in frame.select_dtypes('category').columns})
+    frame['age_order'] = frame['age_order'].where(frame['age_order'] > 0)
+    return frame
+
+
+# What the callbacks computed before the cube existed
+def select(frame, prov, region):
+    if prov == 'All Provinces':
+        return frame.copy()
+    frame = frame[frame['province'] == prov]
+    if region != 'All Regions':
+        frame = frame[frame['health_region'] == region]
+    return frame
+
+
+def legacy_graph(df, prov, region):
+    return pd.pivot_table(select(df, prov, region), index=['date_report'], columns=['province'],
+                          values=['provincial_case_id'], aggfunc='count', fill_value=nan)
+
+
+def legacy_text(df, prov, region):
+    provtext = reg_total = None
+    if prov != 'All Provinces':
+        provtext = sum(df['province'] == prov)
+        if region != 'All Regions':
+            reg_total = len(df[(df['province'] == prov) & (df['health_region'] == region)])
+    return len(df), provtext, reg_total
+
+
+def legacy_agegender(df, prov, region, id_col='provincial_case_id'):
+    df_plot = select(df, prov, region)
+    df_plot = df_plot[~((df_plot['age'] == 'Not Reported') & (df_plot['sex'] == 'Not Reported'))]
+    return df_plot.groupby(['sex', 'age_order'])[id_col].count().unstack(fill_value=0).stack()
+
+
+def series_graph(series, prov, region):
+    if prov == 'All Provinces':
+        return province_window(series, 'daily')
+    return selection_window(series, 'daily', prov, region)
+
+
+def cube_text(cube, prov, region):
+    provtext = reg_total = None
+    if prov != 'All Provinces':
+        provtext = cube.totals.get(selection_key(prov, 'All Regions'), 0)
+        if region != 'All Regions':
+            reg_total = cube.totals.get(selection_key(prov, region), 0)
+    return cube.totals[selection_key('All Provinces', 'All Regions')], provtext, reg_total
+
+
+def cube_agegender(cube, prov, region):
+    return cube.agegender.get(selection_key(prov, region))
+
+
+def check(df, deaths, cases_cube, deaths_cube, cases_series, selections):
+    ''' The cube and series have to give the same numbers as the old code.'''
+    for prov, region in selections:
+        # The series have every date, with 0 where the pivot had no row
+        old = legacy_graph(df, prov, region)['provincial_case_id']
+        new = series_graph(cases_series, prov, region)
+        old = old.reindex(pd.DatetimeIndex(new.index)).fillna(0)
+        if prov == 'All Provinces':
+            pd.testing.assert_frame_equal(old[sorted(old.columns)], new[sorted(new.columns)],
+                                          check_names=False, check_dtype=False)
+        else:
+            pd.testing.assert_series_equal(old[prov], new, check_names=False, check_dtype=False)
+        assert legacy_text(df, prov, region) == cube_text(cases_cube, prov, region)
+        pd.testing.assert_series_equal(legacy_agegender(df, prov, region), cube_agegender(cases_cube, prov, region),
+                                       check_names=False)
+        pd.testing.assert_series_equal(legacy_agegender(deaths, prov, region, 'death_id'),
+                                       cube_agegender(deaths_cube, prov, region), check_names=False)
+
+
+def best_ms(func, *args, number=20):
+    return min(repeat(lambda: func(*args), number=number, repeat=3)) / number * 1000
+
+
+if __name__ == '__main__':
+    df, deaths, update_date = get_covid_data(None, method_='cached')
+    cases_cube = build_cube(df, 'provincial_case_id')
+    deaths_cube = build_cube(deaths, 'death_id')
+    cases_series = build_series(df, 'provincial_case_id', 'date_report')
+    print(f'Build cube: {best_ms(build_cube, df, "provincial_case_id", number=1):.1f} ms')
+    print(f'Build series: {best_ms(build_series, df, "provincial_case_id", "date_report", number=1):.1f} ms')
+    df, deaths = as_before(df), as_before(deaths)
+
+    busiest = df.groupby(['province', 'health_region']).size().idxmax()
+    selections = [('All Provinces', 'All Regions'), (busiest[0], 'All Regions'), busiest]
+    check(df, deaths, cases_cube, deaths_cube, cases_series, selections)
+
+    print(f'{"callback":<12}{"selection":<40}{"before ms":>12}{"after ms":>12}')
+    for prov, region in selections:
+        for name, old, new, built in [('graph', legacy_graph, series_graph, cases_series),
+                                      ('text', legacy_text, cube_text, cases_cube),
+                                      ('agegender', legacy_agegender, cube_agegender, cases_cube)]:
+            print(f'{name:<12}{prov + " / " + region:<40}'
+                  f'{best_ms(old, df, prov, region):>12.3f}{best_ms(new, built, prov, region):>12.4f}')
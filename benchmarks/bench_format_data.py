@@ -0,0 +1,27 @@
+''' Times the vectorized group_age/order_agegroups against the original loops (test.py checks they agree).
+
+Run from the repo root:  python benchmarks/bench_format_data.py
+'''
+import os
+import sys
+from timeit import repeat
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from format_data import group_age, order_agegroups
+from get_covid_data_from_url import read_workbook, local_path
+from test import legacy_group_age, legacy_order_agegroups
+
+
+def best_ms(func, *args, number=5):
+    return min(repeat(lambda: func(*args), number=number, repeat=3)) / number * 1000
+
+
+if __name__ == '__main__':
+    update_date, df, deaths = read_workbook(local_path)
+    ages = pd.concat([df['age']] * 20, ignore_index=True)
+    grouped = group_age(ages)
+    print(f'{len(ages):,} rows{"":<16}{"before ms":>12}{"after ms":>12}')
+    print(f'{"group_age":<28}{best_ms(legacy_group_age, ages):>12.1f}{best_ms(group_age, ages):>12.1f}')
+    print(f'{"order_agegroups":<28}{best_ms(legacy_order_agegroups, grouped):>12.1f}'
+          f'{best_ms(order_agegroups, grouped):>12.1f}')
@@ -0,0 +1,49 @@
+''' Peak memory of reading a large synthetic workbook whole vs streamed in row chunks.
+Each run happens in a fresh process so one can't warm up the other.
+Streaming still loads the workbook's shared strings table up front, so the peak has a floor set by the
+number of distinct strings; above it the peak follows the chunk size rather than the row count.
+
+Run from the repo root:  python benchmarks/bench_memory.py [cases]
+'''
+import json
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import synthetic_path
+
+chunksizes = [0, 50_000, 10_000, 2_000]
+
+
+def measure(path, chunksize):
+    from get_covid_data_from_url import process_workbook
+    tracemalloc.start()
+    start = perf_counter()
+    update_date, df, deaths = process_workbook(path, chunksize=chunksize)
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'chunksize': chunksize, 'rows': len(df), 'seconds': round(seconds, 2),
+            'peak_mb': round(peak / 2 ** 20, 1),
+            'result_mb': round((df.memory_usage(deep=True).sum() + deaths.memory_usage(deep=True).sum()) / 2 ** 20, 1),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10, 1)}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--measure':
+        print(json.dumps(measure(sys.argv[2], int(sys.argv[3]))))
+        sys.exit()
+
+    path = synthetic_path(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000)
+    print(f'{"chunksize":>10}{"rows":>10}{"seconds":>10}{"peak MB":>10}{"result MB":>11}{"max RSS MB":>12}')
+    for chunksize in chunksizes:
+        out = subprocess.run([sys.executable, __file__, '--measure', path, str(chunksize)],
+                             check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        r = json.loads(out.splitlines()[-1])
+        print(f'{r["chunksize"] or "whole":>10}{r["rows"]:>10,}{r["seconds"]:>10}{r["peak_mb"]:>10}'
+              f'{r["result_mb"]:>11}{r["max_rss_mb"]:>12}')
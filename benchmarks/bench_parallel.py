@@ -0,0 +1,43 @@
+''' Wall-clock time to parse and clean a synthetic workbook serially vs in a process pool of 1, 2, 4 and
+every power of two up to the number of cores. Every parallel result is checked against the serial one.
+With one worker the gain is from reading the XML directly; beyond that it is from the extra cores.
+
+Run from the repo root:  python benchmarks/bench_parallel.py [cases] [runs]
+'''
+import os
+import statistics
+import sys
+from time import perf_counter
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import synthetic_path
+from get_covid_data_from_url import process_workbook
+
+
+def timed(runs, **kwargs):
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        result = process_workbook(path, **kwargs)
+        times.append(perf_counter() - start)
+    return statistics.median(times), result
+
+
+if __name__ == '__main__':
+    path = synthetic_path(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    cores = os.cpu_count() or 1
+    workers = sorted({1, 2, 4, cores} | {2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores})
+
+    print(f'{cores} cores')
+    print(f'{"mode":<12}{"seconds":>10}{"speedup":>10}')
+    serial, expected = timed(runs)
+    print(f'{"serial":<12}{serial:>10.2f}{1:>10.2f}')
+    for n in workers:
+        seconds, result = timed(runs, workers=n)
+        assert result[0] == expected[0]
+        for frame, expected_frame in zip(result[1:], expected[1:]):
+            pd.testing.assert_frame_equal(frame, expected_frame)
+        print(f'{f"{n} workers":<12}{seconds:>10.2f}{serial / seconds:>10.2f}')
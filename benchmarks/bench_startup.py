@@ -0,0 +1,63 @@
+''' Time from launching the app until it can serve, and until the first page has data,
+loading eagerly at import vs with COVID_FAST_STARTUP=1, with and without a snapshot of the workbook.
+Each run is a fresh process, offline (COVID_DATA_SOURCE=cached).
+
+Run from the repo root:  python benchmarks/bench_startup.py [runs]
+'''
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(launched, snapshot_dir):
+    ''' Runs in the child: import the app as gunicorn would, then ask for the page.'''
+    import snapshot
+    snapshot.snapshot_dir = snapshot_dir
+    import covid_dash
+    serving = time.time()
+    response = covid_dash.server.test_client().get('/_dash-layout')
+    assert response.status_code == 200
+    return {'serve_s': serving - launched, 'first_page_s': time.time() - launched}
+
+
+def run(fast, snapshot_dir):
+    env = dict(os.environ, COVID_DATA_SOURCE='cached', COVID_REFRESH_INTERVAL='0', COVID_SHARED_DATA='0',
+               COVID_FAST_STARTUP='1' if fast else '0')
+    launched = time.time()
+    out = subprocess.run([sys.executable, __file__, '--measure', str(launched), snapshot_dir], cwd=root, env=env,
+                         check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    # The app's own startup messages can come after the result
+    return json.loads([line for line in out.splitlines() if line.startswith('{"serve_s"')][-1])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--measure':
+        sys.path.insert(0, root)
+        print(json.dumps(measure(float(sys.argv[2]), sys.argv[3])))
+        sys.exit()
+
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print(f'{"startup":<10}{"snapshot":<10}{"serve s":>10}{"first page s":>14}')
+    for fast in [False, True]:
+        for warm in [False, True]:
+            snapshot_dir = tempfile.mkdtemp()
+            try:
+                if warm:
+                    run(fast, snapshot_dir)
+                results = []
+                for _ in range(runs):
+                    if not warm:
+                        shutil.rmtree(snapshot_dir, ignore_errors=True)
+                    results.append(run(fast, snapshot_dir))
+            finally:
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+            print(f'{"fast" if fast else "eager":<10}{"warm" if warm else "cold":<10}'
+                  f'{statistics.median(r["serve_s"] for r in results):>10.2f}'
+                  f'{statistics.median(r["first_page_s"] for r in results):>14.2f}')
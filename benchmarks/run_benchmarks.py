@@ -0,0 +1,208 @@
+''' Times ingest, age grouping and every dashboard callback on synthetic workbooks, offline, and writes JSON.
+
+Run from the repo root:
+    python benchmarks/run_benchmarks.py                              # 10k and 100k cases
+    python benchmarks/run_benchmarks.py --scales 10000,100000,1000000 --out results.json
+    python benchmarks/run_benchmarks.py --compare old.json           # also print the change against old results
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from timeit import repeat
+
+# Nothing may touch the network: load the bundled workbook and keep the refresher off
+os.environ['COVID_DATA_SOURCE'] = 'cached'
+os.environ['COVID_REFRESH_INTERVAL'] = '0'
+os.environ['COVID_SHARED_DATA'] = '0'
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import pandas as pd
+from synthetic import synthetic_path
+import get_covid_data_from_url
+import snapshot
+from get_covid_data_from_url import get_covid_data, read_workbook
+from format_data import group_age, order_agegroups
+from data_store import split_text
+
+results = []
+
+
+def record(scale, name, func, number=1, runs=5, **params):
+    ''' Time func and keep the result. Times are per call, in milliseconds.'''
+    times = [t / number * 1000 for t in repeat(func, number=number, repeat=runs)]
+    results.append({'scale': scale, 'name': name, 'params': params, 'best_ms': round(min(times), 4),
+                    'median_ms': round(statistics.median(times), 4), 'runs': runs, 'number': number})
+    label = name + ''.join(f' {v}' for v in params.values())
+    print(f'{scale:>10,}  {label:<64}{min(times):>12.3f}{statistics.median(times):>12.3f}')
+
+
+def bench_ingest(scale, path):
+    # get_covid_data(method_='cached') reads local_path and snapshots to snapshot_dir; point both elsewhere
+    saved = get_covid_data_from_url.local_path, snapshot.snapshot_dir
+    get_covid_data_from_url.local_path = path
+    snapshot_dir = tempfile.mkdtemp()
+    snapshot.snapshot_dir = snapshot_dir
+    runs = 3 if scale <= 100_000 else 1
+
+    def cold(chunksize=0):
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        return get_covid_data(None, method_='cached', chunksize=chunksize)
+
+    try:
+        record(scale, 'get_covid_data', cold, runs=runs, snapshot='cold')
+        record(scale, 'get_covid_data', lambda: cold(50_000), runs=runs, snapshot='cold', chunksize=50_000)
+        df, deaths, update_date = cold()
+        record(scale, 'get_covid_data', lambda: get_covid_data(None, method_='cached'), runs=runs, snapshot='warm')
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        get_covid_data_from_url.local_path, snapshot.snapshot_dir = saved
+
+    ages = read_workbook(path)[1]['age']
+    record(scale, 'group_age', lambda: group_age(ages), runs=runs)
+    grouped = group_age(ages)
+    record(scale, 'order_agegroups', lambda: order_agegroups(grouped), runs=runs)
+    return df, deaths, update_date
+
+
+def callback_body(outputs, inputs):
+    ''' A /_dash-update-component request as dash-renderer sends it.'''
+    output = '..' + '...'.join(f'{i}.{p}' for i, p in outputs) + '..' if len(outputs) > 1 else '.'.join(outputs[0])
+    return {'output': output,
+            'outputs': [{'id': i, 'property': p} for i, p in outputs] if len(outputs) > 1 else
+                       {'id': outputs[0][0], 'property': outputs[0][1]},
+            'inputs': [{'id': i, 'property': p, 'value': v} for i, p, v in inputs],
+            'changedPropIds': [f'{inputs[0][0]}.{inputs[0][1]}']}
+
+
+def table_body(table, prov, region, page, sort_by, filter_query):
+    return callback_body([(table, 'data'), (table, 'page_count')],
+                         [('Province', 'value', prov), ('Region', 'value', region), (table, 'page_current', page),
+                          (table, 'page_size', 15), (table, 'sort_by', sort_by),
+                          (table, 'filter_query', filter_query)])
+
+
+def case_graph_body(prov, region, start_date, end_date, kind):
+    return callback_body([('funnel-graph', 'figure')],
+                         [('Province', 'value', prov), ('Region', 'value', region),
+                          ('date-range', 'start_date', start_date), ('date-range', 'end_date', end_date),
+                          ('series-kind', 'value', kind)])
+
+
+def selections(df):
+    ''' All of Canada, the busiest province and region, and the quietest province.'''
+    counts = df.groupby([df['province'].astype(object), df['health_region'].astype(object)]).size()
+    busiest = counts.idxmax()
+    by_province = counts.sum(level=0)
+    return [('All Provinces', 'All Regions'), (busiest[0], 'All Regions'), busiest,
+            (by_province.idxmin(), 'All Regions')]
+
+
+def bench_callbacks(scale, df, deaths, update_date):
+    import covid_dash
+    df, case_text = split_text(df)
+    deaths, death_text = split_text(deaths)
+    covid_dash.store.swap(df, deaths, case_text, death_text, update_date, f'synthetic-{scale}')
+    # Let background payload rendering finish so it doesn't compete with the timings
+    covid_dash.payload_cache.prerender()
+    for thread in threading.enumerate():
+        if thread.name == 'payload-prerender':
+            thread.join()
+    client = covid_dash.server.test_client()
+
+    by_date = [{'column_id': 'date_report', 'direction': 'desc'}]
+    by_age = [{'column_id': 'age_order', 'direction': 'asc'}]
+    requests = []
+    for prov, region in selections(df):
+        if region == 'All Regions':
+            requests.append(('update_region', {'province': prov},
+                             callback_body([('Region', 'options'), ('Region', 'value')],
+                                           [('Province', 'value', prov)])))
+        requests += [
+            ('update_selection', {'province': prov, 'region': region},
+             callback_body([('canadatext_subtitle', 'children'),
+                            ('provtext_subtitle', 'children'), ('reg_total', 'children'),
+                            ('agegender-graph', 'figure'), ('death-graph', 'figure')],
+                           [('Province', 'value', prov), ('Region', 'value', region)])),
+            ('update_case_graph', {'province': prov, 'region': region, 'view': 'latest days'},
+             case_graph_body(prov, region, None, None, 'daily')),
+            ('update_case_graph', {'province': prov, 'region': region, 'view': 'all weeks'},
+             case_graph_body(prov, region, '2020-01-01', None, 'weekly')),
+            ('update_table', {'province': prov, 'region': region, 'view': 'first page'},
+             table_body('filtered-datatable', prov, region, 0, [], '')),
+            ('update_table', {'province': prov, 'region': region, 'view': 'page 3 by date'},
+             table_body('filtered-datatable', prov, region, 3, by_date, '')),
+            ('update_table', {'province': prov, 'region': region, 'view': 'filtered by age'},
+             table_body('filtered-datatable', prov, region, 0, [], '{age} = 40-49')),
+            ('update_deathstable', {'province': prov, 'region': region, 'view': 'first page'},
+             table_body('death-df', prov, region, 0, [], '')),
+            ('update_deathstable', {'province': prov, 'region': region, 'view': 'page 2 by age'},
+             table_body('death-df', prov, region, 2, by_age, '')),
+        ]
+
+    def post(body):
+        response = client.post('/_dash-update-component', json=body)
+        assert response.status_code == 200, response.data
+        return response
+
+    for name, params, body in requests:
+        # Cold: nothing cached for this data version yet
+        def cold():
+            covid_dash.callback_cache.clear()
+            covid_dash.payload_cache.clear()
+            return post(body)
+        record(scale, name, cold, runs=5, cache='cold', **params)
+        post(body)
+        record(scale, name, lambda: post(body), number=20, runs=3, cache='warm', **params)
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'timestamp': datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'pandas': pd.__version__, 'machine': platform.platform()}
+
+
+def compare(old_path):
+    ''' Print the change in median time against an earlier results file.'''
+    with open(old_path) as f:
+        old = {(r['scale'], r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(f)['results']}
+    print(f'\nChange against {old_path} (median)')
+    for r in results:
+        before = old.get((r['scale'], r['name'], json.dumps(r['params'], sort_keys=True)))
+        if before and before['median_ms'] > 0:
+            label = r['name'] + ''.join(f' {v}' for v in r['params'].values())
+            print(f'{r["scale"]:>10,}  {label:<64}{r["median_ms"] / before["median_ms"] - 1:>+12.1%}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default='10000,100000', help='comma separated case counts')
+    parser.add_argument('--out', default=None, help='results file (default benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    print(f'{"cases":>10}  {"benchmark":<64}{"best ms":>12}{"median ms":>12}')
+    for scale in [int(s) for s in args.scales.split(',')]:
+        path = synthetic_path(scale)
+        df, deaths, update_date = bench_ingest(scale, path)
+        bench_callbacks(scale, df, deaths, update_date)
+
+    out = args.out or os.path.join(root, 'benchmarks', 'results', f'{datetime.now():%Y%m%d-%H%M%S}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump({'meta': metadata(), 'results': results}, f, indent=1)
+    print(f'Results written to {out}')
+    if args.compare:
+        compare(args.compare)
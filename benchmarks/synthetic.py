@@ -0,0 +1,101 @@
+''' Writes a synthetic workbook laid out like the Google Sheets export (Cases and Mortality sheets).
+
+Run from the repo root:  python benchmarks/synthetic.py 100000 Data/synthetic-100000.xlsx
+'''
+import os
+import sys
+from datetime import datetime, timedelta
+import numpy as np
+import xlsxwriter
+
+case_header = ['case_id', 'provincial_case_id', 'age', 'sex', 'health_region', 'province', 'country',
+               'date_report', 'report_week', 'travel_yn', 'travel_history_country', 'locally_acquired',
+               'case_source', 'additional_info']
+death_header = ['death_id', 'province_death_id', 'case_id', 'age', 'sex', 'health_region', 'province', 'country',
+                'date_death_report', 'death_source', 'additional_info', 'additional_source']
+
+regions = [('Ontario', 'Toronto'), ('Ontario', 'Ottawa'), ('Ontario', 'Peel'), ('Ontario', 'Not Reported'),
+           ('Quebec', 'Montréal'), ('Quebec', 'Laval'), ('Quebec', 'Not Reported'), ('BC', 'Vancouver Coastal'),
+           ('BC', 'Fraser'), ('Alberta', 'Calgary'), ('Alberta', 'Edmonton'), ('Saskatchewan', 'Saskatoon'),
+           ('Manitoba', 'Winnipeg'), ('Nova Scotia', 'Zone 4'), ('New Brunswick', 'Zone 1'), ('NL', 'Eastern'),
+           ('PEI', 'Not Reported'), ('Yukon', 'Not Reported'), ('NWT', 'Not Reported'),
+           ('Repatriated', 'Not Reported')]
+# The mix of labels, bare numbers and odd strings the sheet's age column actually holds
+ages = ['20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80-89', '90-99', '<20', '<10', '>70', '>80',
+        'Not Reported', 'Not Reported', 'Not Reported', 45, 67, 12, 2.5, '']
+sexes = ['Male', 'Female', 'Not Reported']
+countries = ['Not Reported', 'China', 'Iran', 'United States', 'Italy', 'France']
+first_day = datetime(2020, 1, 15)
+
+
+def write_sheet(workbook, name, header, rows, update_date):
+    sheet = workbook.add_worksheet(name)
+    date_format = workbook.add_format({'num_format': 'dd-mm-yyyy'})
+    sheet.write(0, 0, f'Last update: {update_date}')
+    sheet.write(1, 0, 'Synthetic data for benchmarks')
+    sheet.write(2, 0, 'Generated by benchmarks/synthetic.py')
+    sheet.write_row(3, 0, header)
+    for i, row in enumerate(rows, start=4):
+        for j, value in enumerate(row):
+            if value is None or value == '':
+                continue
+            if isinstance(value, datetime):
+                sheet.write_datetime(i, j, value, date_format)
+            else:
+                sheet.write(i, j, value)
+
+
+def case_rows(n, rng):
+    region = rng.integers(len(regions), size=n)
+    age = rng.integers(len(ages), size=n)
+    sex = rng.integers(len(sexes), size=n)
+    # Case counts grow over the period, a few reports predate 2020
+    day = (rng.power(2, size=n) * 160).astype(int) - 20
+    travel = rng.integers(3, size=n)
+    for i in range(n):
+        province, health_region = regions[region[i]]
+        date_report = first_day + timedelta(days=int(day[i]))
+        yield [i + 1, i + 1, ages[age[i]], sexes[sex[i]], health_region, province, 'Canada', date_report,
+               date_report - timedelta(days=date_report.weekday()),
+               ['Not Reported', 0, 1][travel[i]], countries[i % len(countries)] if travel[i] == 2 else 'Not Reported',
+               None, f'https://example.org/report/{i}', 'Close contact of a known case' if i % 4 == 0 else None]
+
+
+def death_rows(n, rng):
+    region = rng.integers(len(regions), size=n)
+    age = rng.integers(len(ages), size=n)
+    sex = rng.integers(len(sexes), size=n)
+    day = (rng.power(2, size=n) * 140).astype(int) + 20
+    for i in range(n):
+        province, health_region = regions[region[i]]
+        yield [i + 1, i + 1, None, ages[age[i]], sexes[sex[i]], health_region, province, 'Canada',
+               first_day + timedelta(days=int(day[i])), f'https://example.org/death/{i}',
+               'Long-term care resident' if i % 3 == 0 else None, None]
+
+
+def write_workbook(path, cases, deaths=None, seed=0):
+    ''' Write cases rows (and deaths rows, default 5% of cases) to path.'''
+    if deaths is None:
+        deaths = max(cases // 20, 1)
+    rng = np.random.default_rng(seed)
+    update_date = f'{datetime.now():%d %B %Y, %H:%M} EST'
+    # constant_memory streams each row to disk, so writing 1M rows doesn't hold the sheet in memory
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+    write_sheet(workbook, 'Cases', case_header, case_rows(cases, rng), update_date)
+    write_sheet(workbook, 'Mortality', death_header, death_rows(deaths, rng), update_date)
+    workbook.close()
+    return path
+
+
+def synthetic_path(cases):
+    ''' Cached workbook of the given size under Data/, written on first use.'''
+    path = os.path.join('Data', f'synthetic-{cases}.xlsx')
+    if not os.path.exists(path):
+        print(f'Writing {cases:,} synthetic cases to {path}')
+        write_workbook(path, cases)
+    return path
+
+
+if __name__ == '__main__':
+    cases = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    write_workbook(sys.argv[2] if len(sys.argv) > 2 else f'Data/synthetic-{cases}.xlsx', cases)
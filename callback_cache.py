@@ -0,0 +1,61 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+# Most results kept across all memoized callbacks (0 turns caching off)
+cache_size = int(os.environ.get('COVID_CALLBACK_CACHE_SIZE', 512))
+
+
+class CallbackCache:
+    ''' LRU cache of callback results keyed on the callback, its inputs and the data version.
+    Everything is dropped as soon as a new data version is seen.'''
+
+    def __init__(self, maxsize=cache_size):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def memoize(self, get_version):
+        ''' Decorator; get_version returns the version of the data the callback reads.'''
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args):
+                version = get_version()
+                # Inputs like sort_by are lists of dicts, so key on their JSON
+                key = (func.__name__, json.dumps(args, sort_keys=True))
+                with self._lock:
+                    if version != self._version:
+                        self._entries.clear()
+                        self._version = version
+                    if key in self._entries:
+                        self.hits += 1
+                        self._entries.move_to_end(key)
+                        return self._entries[key]
+                    self.misses += 1
+
+                result = func(*args)
+                with self._lock:
+                    if self.maxsize > 0 and version == self._version:
+                        self._entries[key] = result
+                        while len(self._entries) > self.maxsize:
+                            self._entries.popitem(last=False)
+                            self.evictions += 1
+                return result
+            return wrapper
+        return decorator
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries), 'maxsize': self.maxsize, 'data_version': self._version}
@@ -1,30 +1,59 @@
+from time import perf_counter
+# Startup time is counted from here
+started = perf_counter()
+import gzip
+import os
+import threading
 import dash
-import dash_table
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output
 import plotly.graph_objs as go
 import pandas as pd
-from numpy import nan
 from province_names import prov_names
-from get_covid_data_from_url import get_covid_data
-from format_data import group_age, order_agegroups, inverse_order_dict
+from data_store import DataStore, memory_report, shared_data_enabled
+from format_data import inverse_order_dict
+from get_covid_data_from_url import keep_cols, keep_cols_death
+from viz_table import generate_dashtable, filter_frame, sort_frame, get_page
+from aggregates import selection_key, select_rows
+from timeseries import selection_window, province_window
+from callback_cache import CallbackCache
+from payloads import PayloadCache
+from export_api import export_blueprint
+import metrics
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
-covid_case_url = r'https://docs.google.com/spreadsheets/d/1D6okqtBS3S2NRC7GFVHzaZ67DuTw7LX49-fqSLwJyeo/export?format=xlsx'
-
-
-df, deaths, update_date = get_covid_data(covid_case_url, method_='url')
-
-# Clean age group data
-for x in [df, deaths]:
-    x['age'] = group_age(x['age'])
-    x['age_order'] = order_agegroups(x['age'])
+# Where the first load comes from: 'url', or 'cached' for the bundled workbook (e.g. offline)
+data_source = os.environ.get('COVID_DATA_SOURCE', 'url')
+
+# Start serving before any data is loaded: load the local workbook (or its snapshot) and then data_source in
+# the background, and let requests wait for the first load
+fast_startup = os.environ.get('COVID_FAST_STARTUP', '0') == '1'
+
+if shared_data_enabled:
+    from shared_data import SharedDataStore
+    store = SharedDataStore()
+else:
+    store = DataStore()
+if fast_startup:
+    store.load_in_background(data_source, started)
+else:
+    # Load once now, then keep refreshing in the background
+    store.load(method_=data_source)
+    print(memory_report(store.get()))
+    store.start_refresher()
 
 app = dash.Dash()
 server = app.server
+
+# Results per (callback, inputs), dropped whenever the data version changes
+callback_cache = CallbackCache()
+memoize = callback_cache.memoize(lambda: store.get().version)
+# Gzipped JSON of the selection outputs and first table pages, rendered once per data version
+payload_cache = PayloadCache(store.get)
 app.title = 'COVID-19 Dashboard for Canada'
 
 
@@ -50,223 +79,200 @@ colname_dict = {'provincial_case_id': 'Provincial ID', 'age': 'Age Range', 'sex'
                 'additional_info': 'Additional Info', 'age_order': 'Age (order)', 'death_id': 'ID',
                 'date_death_report': 'Report Date'}
 
+# Columns shown in the tables
+case_table_cols = [i for i in keep_cols if i != 'report_week']
+death_table_cols = keep_cols_death + ['age_order']
+table_page_size = 15
+
+# The case graph shows this many days up to the latest unless a start date is picked
+default_window_days = 60
+series_labels = {'daily': 'Daily', 'weekly': 'Weekly', 'rolling': '7-day average'}
+# Days between bars of each series (date axis steps are in milliseconds)
+bar_step_days = {'daily': 1, 'weekly': 7, 'rolling': 1}
+
+
+def build_layout(data):
+    ''' The page for a Dataset, or with only the All Provinces option while data is None.'''
+    provinces = [] if data is None else data.case_index.provinces
+    update_date = 'loading' if data is None else data.update_date
+    return html.Div(
+        style={'backgroundColor': layout['main_bg'],
+               'textAlign': 'center',
+               'font-family': 'arial'},
+        children=[
+            html.H1(children='COVID-19 Confirmed Cases in Canada by Date Reported'),
+            html.H3(id='update-date', children=f'(Last refresh: {update_date})'),
+            dcc.Interval(id='refresh-check', interval=60_000),
+            html.P(children='Built by Fabienne Chan. Data is crowd-sourced and I do not take liability for faulty reporting.'),
+            html.A("[Data source]", href="https://docs.google.com/spreadsheets/d/1D6okqtBS3S2NRC7GFVHzaZ67DuTw7LX49-fqSLwJyeo/"),
+            html.A("[GitHub]", href="https://github.com/fabhlc/covid-dash"),
+
+            # Dropdown
+            html.Div(children='''Select geography:'''),
+            html.Div([dcc.Dropdown(id='Province',
+                                   options=[{'label': prov_names[i],
+                                             'value': i
+                                             } for i in ['All Provinces'] + provinces],
+                                   value='All Provinces')],
+                     style={'width': '25%',
+                            'display': 'inline-block'}),
+            html.Div([dcc.Dropdown(id='Region',
+                                   options=[{'label': 'All Regions', 'value': 'All Regions'}],#{'label': i,
+                                             # 'value': i
+                                             # } for i in listt(set(df['health_region'])) + ['All Regions']],
+                                   value='All Regions')],
+                     style={'width': '25%',
+                            'display': 'inline-block'}),
+
+            # keycards
+            html.Div(
+                dbc.Row(
+                    [dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                [html.H4(children='Canada Total', className="card-title"),
+                                 html.H1(id='canadatext_subtitle', className="card-subtitle")]),
+                            color="info",
+                            outline=True)),
+                     dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                [html.H4(children='Provincial Total', className="card-title"),
+                                 html.H1(id='provtext_subtitle', className="card-subtitle")]),
+                            color="info",
+                            outline=True)),
+                     dbc.Col(
+                        dbc.Card(
+                            dbc.CardBody(
+                                [html.H4(children='Regional Total', className="card-title"),
+                                 html.H1(id='reg_total', className="card-subtitle")]),
+                            color="info",
+                            outline=True))
+                     ])
+            ),
+            html.Div([dcc.DatePickerRange(id='date-range',
+                                          start_date_placeholder_text=f'Last {default_window_days} days',
+                                          end_date_placeholder_text='Latest',
+                                          display_format='YYYY-MM-DD',
+                                          clearable=True),
+                      dcc.RadioItems(id='series-kind',
+                                     options=[{'label': label, 'value': kind} for kind, label in series_labels.items()],
+                                     value='daily',
+                                     labelStyle={'display': 'inline-block'})]),
+            dcc.Graph(id='funnel-graph'),
+            html.H4(children='Individual COVID cases'),
+            generate_dashtable([{"name": colname_dict[i], "id": i} for i in case_table_cols],
+                               id_='filtered-datatable',
+                               page_size_val=table_page_size,
+                               style_header={'fontWeight': 'bold',
+                                             'backgroundColor': '#cdc9c9'},
+                               style_data_conditional=[{'if': {'row_index': 'odd'},
+                                                        'backgroundColor': '#fffafa'}]),
+            dcc.Graph(id='agegender-graph'),
+            html.Div(children='* - Excluding records where neither sex nor age are reported.',
+                     style={'color': 'grey', 'fontsize': 9}),
+
+            # Deaths
+            html.Div(
+                [html.H4(children='Fatal Cases of Covid'),
+                 generate_dashtable([{"name": colname_dict[i], "id": i} for i in death_table_cols],
+                                    id_='death-df',
+                                    page_size_val=table_page_size,
+                                    style_header={'fontWeight': 'bold',
+                                                  'backgroundColor': '#cdc9c9'},
+                                    style_data_conditional=[{'if': {'row_index': 'odd'},
+                                                             'backgroundColor': '#fffafa'}]
+                                    ),
+                 dcc.Graph(id='death-graph'),
+                 html.Div(children='* - Excluding records where neither sex nor age are reported.',
+                          style={'color': 'grey', 'fontsize': 9})
+                 ],
+            )
+    ])
 
-app.layout = html.Div(
-    style={'backgroundColor': layout['main_bg'],
-           'textAlign': 'center',
-           'font-family': 'arial'},
-    children=[
-        html.H1(children='COVID-19 Confirmed Cases in Canada by Date Reported'),
-        html.H3(children=f'(Last refresh: {update_date})'),
-        html.P(children='Built by Fabienne Chan. Data is crowd-sourced and I do not take liability for faulty reporting.'),
-        html.A("[Data source]", href="https://docs.google.com/spreadsheets/d/1D6okqtBS3S2NRC7GFVHzaZ67DuTw7LX49-fqSLwJyeo/"),
-        html.A("[GitHub]", href="https://github.com/fabhlc/covid-dash"),
-
-        # Dropdown
-        html.Div(children='''Select geography:'''),
-        html.Div([dcc.Dropdown(id='Province',
-                               options=[{'label': prov_names[i],
-                                         'value': i
-                                         } for i in ['All Provinces'] + sorted(list(df.province.unique()))],
-                               value='All Provinces')],
-                 style={'width': '25%',
-                        'display': 'inline-block'}),
-        html.Div([dcc.Dropdown(id='Region',
-                               options=[{'label': 'All Regions', 'value': 'All Regions'}],#{'label': i,
-                                         # 'value': i
-                                         # } for i in listt(set(df['health_region'])) + ['All Regions']],
-                               value='All Regions')],
-                 style={'width': '25%',
-                        'display': 'inline-block'}),
-
-        # keycards
-        html.Div(
-            dbc.Row(
-                [dbc.Col(
-                    dbc.Card(
-                        dbc.CardBody(
-                            [html.H4(children='Canada Total', className="card-title"),
-                             html.H1(id='canadatext_subtitle', className="card-subtitle")]),
-                        color="info",
-                        outline=True)),
-                 dbc.Col(
-                    dbc.Card(
-                        dbc.CardBody(
-                            [html.H4(children='Provincial Total', className="card-title"),
-                             html.H1(id='provtext_subtitle', className="card-subtitle")]),
-                        color="info",
-                        outline=True)),
-                 dbc.Col(
-                    dbc.Card(
-                        dbc.CardBody(
-                            [html.H4(children='Regional Total', className="card-title"),
-                             html.H1(id='reg_total', className="card-subtitle")]),
-                        color="info",
-                        outline=True))
-                 ])
-        ),
-        dcc.Graph(id='funnel-graph'),
-        html.H4(children='Individual COVID cases'),
-        dash_table.DataTable(id='filtered-datatable',
-                             page_size=15,
-                             page_current=0,
-                             style_header={'fontWeight': 'bold',
-                                           'backgroundColor': '#cdc9c9'},
-                             style_data_conditional=[{'if': {'row_index': 'odd'},
-                                                     'backgroundColor': '#fffafa'}]),
-        dcc.Graph(id='agegender-graph'),
-        html.Div(children='* - Excluding records where neither sex nor age are reported.',
-                 style={'color': 'grey', 'fontsize': 9}),
-
-        # Deaths
-        html.Div(
-            [html.H4(children='Fatal Cases of Covid'),
-             dash_table.DataTable(id='death-df',
-                                  page_size=15,
-                                  page_current=0,
-                                  style_header={'fontWeight': 'bold',
-                                                'backgroundColor': '#cdc9c9'},
-                                  style_data_conditional=[{'if': {'row_index': 'odd'},
-                                                           'backgroundColor': '#fffafa'}]
-                                  ),
-             dcc.Graph(id='death-graph'),
-             html.Div(children='* - Excluding records where neither sex nor age are reported.',
-                      style={'color': 'grey', 'fontsize': 9})
-             ],
-        )
-])
-
-@app.callback(
-    Output('funnel-graph', 'figure'),
-    [Input('Province', 'value'), Input('Region', 'value')])
-def update_graph(prov, region):
-    title_addendum = ''
-    if prov == "All Provinces":
-        df_plot = df.copy()
-    else:
-        df_plot = df[df['province'] == prov]
-        if region != 'All Regions':
-            df_plot = df_plot[df_plot['health_region'] == region]
-            title_addendum = f' ({region})'
-
-    pv = pd.pivot_table(df_plot,
-                        index=['date_report'],
-                        columns=['province'],
-                        values=['provincial_case_id'],
-                        aggfunc='count',
-                        fill_value=nan)
-    if prov == 'All Provinces':
-        trace1 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'Ontario')], name='Ontario')
-        trace2 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'BC')], name='British Columbia')
-        trace3 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'Alberta')], name='Alberta')
-        trace4 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'Manitoba')], name='Manitoba')
-        trace5 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'NL')], name='Newfoundland and Labrador')
-        trace6 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'New Brunswick')], name='New Brunswick')
-        trace7 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'Quebec')], name='Quebec')
-        trace8 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'Yukon')], name='Yukon')
-        trace9 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'Saskatchewan')], name='Saskatchewan')
-        trace10 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'PEI')], name='Prince Edward Island')
-        trace11 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'Nova Scotia')], name='Nova Scotia')
-        trace12 = go.Bar(x=pv.index, y=pv[('provincial_case_id', 'NWT')], name='Northwest Territories')
-
-        traces = [trace1, trace2, trace3, trace4, trace5, trace6, trace7, trace8, trace9, trace10, trace11, trace12]
-    else:
-        trace1 = go.Bar(x=pv.index, y=pv[('provincial_case_id', prov)], name=prov_names[prov])
-        traces = [trace1]
-
-    return {
-        'data': traces,
-        'layout': go.Layout(
-            title=f'Cases in {prov}{title_addendum}',
-            barmode='stack')
-    }
 
+def serve_layout():
+    # Built for every page load, so the header and provinces follow refreshes
+    return build_layout(store.get())
 
-# Always update region to "All Regions" when province is changed.
-@app.callback(
-    Output("Region", "value"),
-    [Input("Province", "value")])
-def refresh_region(prov):
-    return 'All Regions'
 
+# Callbacks are checked against this page when they are registered; serve_layout takes over at the end
+app.layout = build_layout(None)
 
-# Update region list to change to region to province's regions
-@app.callback(
-    Output("Region", "options"),
-    [Input("Province", "value")])
-def update_region(prov):
-    region_list = [{'label': 'All Regions', 'value': 'All Regions'}]
-    if prov != 'All Provinces':
-        region_list = list(set(df[df['province'] == prov]['health_region']))
-        region_list = [{'label': i, 'value': i} for i in ['All Regions'] + sorted(region_list)]
-    return region_list
+# Output builders, fed with the aggregates of one data version
+def case_figure(series, prov, region, start_date=None, end_date=None, kind='daily'):
+    title_addendum = ''
+    if prov != "All Provinces" and region != 'All Regions':
+        title_addendum = f' ({region})'
+    if kind != 'daily':
+        title_addendum += f', {series_labels[kind].lower()}'
+
+    # Only the window is sent, so the payload doesn't grow with the history
+    start_date = start_date and pd.Timestamp(start_date)
+    end_date = end_date and pd.Timestamp(end_date)
+    if start_date is None and len(series.daily.columns) > 0:
+        # The default window ends at the chosen end date, or the latest day
+        last_day = series.daily.columns[-1] if end_date is None else min(end_date, series.daily.columns[-1])
+        start_date = last_day - pd.Timedelta(days=default_window_days - 1)
 
-# Cases Table
-@app.callback(
-    [Output('filtered-datatable', 'columns'), Output('filtered-datatable', 'data')],
-    [Input('Province', 'value'), Input('Region', 'value')])
-def update_graph(prov, region):
-    if prov == "All Provinces":
-        df_plot = df.copy()
+    if prov == 'All Provinces':
+        # Counts by date and province, for every province in the data
+        counts = province_window(series, kind, start_date, end_date)
+        # Largest first, so the biggest provinces sit at the bottom of the stacks
+        totals = province_window(series, 'daily').sum()
+        counts = counts[totals.sort_values(ascending=False, kind='mergesort').index]
     else:
-        df_plot = df[df['province'] == prov]
-        if region != 'All Regions':
-            df_plot = df_plot[df_plot['health_region'] == region]
+        counts = selection_window(series, kind, prov, region, start_date, end_date).to_frame(prov)
 
-    # Format datetime
-    df_plot.loc[:, 'date_report'] = df_plot['date_report'].dt.strftime('%d-%m-%Y')
+    return {
+        'data': bar_traces(counts, kind),
+        'layout': {'title': f'Cases in {prov}{title_addendum}',
+                   'barmode': 'stack',
+                   'xaxis': {'type': 'date'}}
+    }
 
-    # Edit columns (format, drop, rename)
-    df_plot.drop(['age_order', 'report_week'], axis=1, inplace=True)
 
-    cols = [{"name": colname_dict[i], "id": i} for i in df_plot.columns]
-    data_ = df_plot.to_dict('records')
-    return cols, data_
+def bar_traces(counts, kind):
+    ''' One bar trace per column of a dates x provinces frame. The traces share their dates, sent as the first
+    date and a step rather than a list per trace, and counts are sent as ints (averages to 2 decimals).'''
+    x0 = counts.index[0].strftime('%Y-%m-%d') if len(counts) else None
+    values = counts.round(2) if kind == 'rolling' else counts.astype('int64')
+    return [{'type': 'bar',
+             'name': prov_names.get(col, col),
+             'x0': x0,
+             'dx': bar_step_days[kind] * 86_400_000,
+             'y': values[col].tolist()} for col in counts.columns]
 
 
-# Update keycards
-@app.callback(
-    [Output("canadatext_subtitle", "children"),
-     Output("provtext_subtitle", "children"),
-     Output("reg_total", "children")],
-    [Input("Province", "value"),
-     Input("Region", "value")])
-def update_text(prov, region):
-    canadatext = "{:,}".format(len(df))
+# Keycards
+def keycards(cube, prov, region):
+    totals = cube.totals
+    canadatext = "{:,}".format(totals[selection_key('All Provinces', 'All Regions')])
     provtext = '-'
     reg_total = '-'
     if prov != 'All Provinces':
-        provtext = "{:,}".format(sum(df['province'] == prov))
+        provtext = "{:,}".format(totals.get(selection_key(prov, 'All Regions'), 0))
         if region != 'All Regions':
-            reg_total = '{:,}'.format(len(df[(df['province'] == prov) & (df['health_region'] == region)]))
+            reg_total = '{:,}'.format(totals.get(selection_key(prov, region), 0))
     return canadatext, provtext, reg_total
 
 
-# Update age/gender distribution - bar chart
-@app.callback(
-    Output("agegender-graph", "figure"),
-    [Input("Province", "value"), Input("Region", 'value')])
-def update_agegender(prov, region):
+# Age/gender distribution - bar chart
+def agegender_figure(cube, prov, region):
     if prov == 'All Provinces':
-        df_plot = df.copy()
         geo_name = 'Canada'
     else:
-        df_plot = df[df['province'] == prov]
         geo_name = prov
         if region != 'All Regions':
-            df_plot = df_plot[df_plot['health_region'] == region]
             geo_name = f"{prov} {(region)}"
 
-    # Drop if row doesn't have values for either age or sex
-    df_plot = df_plot[~((df_plot['age']=='Not Reported') & (df_plot['sex'] == 'Not Reported'))]
+    # Counts by sex and age, excluding rows without either
+    df_plot = cube.agegender.get(selection_key(prov, region), pd.Series(dtype='int64'))
 
     # If there are not reported values:
     output_data = []
     tick_vals =[]
     if len(df_plot) > 0:
-        # Group
-        df_plot = df_plot.groupby(['sex', 'age_order'])['provincial_case_id'].count().unstack(fill_value=0).stack()
-
         # If gender data exists for province, add to figure data
         for (sx, colour) in [('Female', layout['Female']), ('Male', layout['Male']), ('Not Reported', layout['Not Reported'])]:
             try:
@@ -290,33 +296,20 @@ def update_agegender(prov, region):
     }
 
 
-@app.callback(
-    [Output('death-df', 'columns'), Output('death-df', 'data'), Output('death-graph', 'figure')],
-    [Input('Province', 'value'), Input('Region', 'value')])
-def update_deathsdf(prov, region):
+# Deaths by age/gender - bar chart
+def death_figure(cube, prov, region):
     if_region = ''
-    if prov == 'All Provinces':
-        death_plot = deaths.copy()
-        death_count = len(deaths)
-    else:
-        death_plot = deaths[deaths['province'] == prov]
-        death_count = sum(deaths['province'] == prov)
-
-        if region != 'All Regions':
-            death_plot = death_plot[death_plot['health_region'] == region]
-            death_count = sum(death_plot['health_region'] == region)
-            if_region = f' ({region})'
+    if prov != 'All Provinces' and region != 'All Regions':
+        if_region = f' ({region})'
+    death_count = cube.totals.get(selection_key(prov, region), 0)
 
-    cols = [{"name": colname_dict[i], "id": i} for i in death_plot.columns]
-    data_ = death_plot.to_dict('records')
-
-    if len(death_plot) > 0:
+    if death_count > 0:
         # Graph
-        death_plot = death_plot[~((death_plot['age'] == 'Not Reported') & (death_plot['sex'] == 'Not Reported'))]
-        death_plot = death_plot.groupby(['sex', 'age_order'])['death_id'].count().unstack(fill_value=0).stack()
+        death_plot = cube.agegender.get(selection_key(prov, region), pd.Series(dtype='int64'))
 
         # If gender data exists for province, add to figure data
         death_plot_data_data = []
+        tick_vals = []
         for (sx, colour) in [('Female', layout['Female']), ('Male', layout['Male']), ('Not Reported', layout['Not Reported'])]:
             if sx in [i[0] for i in death_plot.index]:
                 death_plot_data_data.append({'x': death_plot[sx].index,
@@ -326,7 +319,7 @@ def update_deathsdf(prov, region):
                                              'color': colour})
                 tick_vals = death_plot[sx].index
     else:
-        tmp = deaths.groupby(['sex', 'age_order'])['death_id'].count().Male.index
+        tmp = cube.agegender[selection_key('All Provinces', region)].Male.index
         death_plot_data_data = [{'x': tmp,
                                  'y': [0 for i in tmp], 'type': 'bar', 'name': 'null', 'color': 'primary'}]
         tick_vals = tmp
@@ -341,7 +334,225 @@ def update_deathsdf(prov, region):
             )
         }
 
-    return cols, data_, death_plot_data
+    return death_plot_data
+
+
+# Pick up background refreshes in the header
+@app.callback(
+    Output('update-date', 'children'),
+    [Input('refresh-check', 'n_intervals')])
+def update_refresh_date(n):
+    return f'(Last refresh: {store.get().update_date})'
+
+
+# Update region list to the province's regions, and always reset region to "All Regions" when province is changed.
+@app.callback(
+    [Output("Region", "options"), Output("Region", "value")],
+    [Input("Province", "value")])
+@memoize
+def update_region(prov):
+    regions = store.get().case_index.regions
+    region_list = [{'label': 'All Regions', 'value': 'All Regions'}]
+    if prov != 'All Provinces':
+        region_list = [{'label': i, 'value': i} for i in ['All Regions'] + regions.get(prov, [])]
+    return region_list, 'All Regions'
+
+# Go back to the first page of both tables when the selection changes
+@app.callback(
+    [Output('filtered-datatable', 'page_current'), Output('death-df', 'page_current')],
+    [Input('Province', 'value'), Input('Region', 'value')])
+def reset_table_pages(prov, region):
+    return 0, 0
+
+
+def case_table(data, prov, region, page_current, page_size, sort_by, filter_query):
+    df_plot = select_rows(data.df, data.case_index, prov, region)
+    metrics.count_rows(len(df_plot))
+    df_plot = filter_frame(df_plot, filter_query, date_cols=['date_report'], text=data.case_text)
+    df_plot = sort_frame(df_plot, sort_by, text=data.case_text)
+    return get_page(df_plot, case_table_cols, page_current, page_size, date_cols=['date_report'],
+                    text=data.case_text)
+
+
+def death_table(data, prov, region, page_current, page_size, sort_by, filter_query):
+    death_plot = select_rows(data.deaths, data.death_index, prov, region)
+    metrics.count_rows(len(death_plot))
+    death_plot = filter_frame(death_plot, filter_query, date_cols=['date_death_report'], text=data.death_text)
+    death_plot = sort_frame(death_plot, sort_by, text=data.death_text)
+    return get_page(death_plot, death_table_cols, page_current, page_size, date_cols=['date_death_report'],
+                    text=data.death_text)
+
+
+def is_first_page(page_current, page_size, sort_by, filter_query):
+    ''' The table as it is first shown for a selection, which the payload cache holds.'''
+    return not page_current and page_size == table_page_size and not sort_by and not filter_query
+
+
+def selections(data):
+    ''' Every (province, region) pair the dropdowns offer.'''
+    pairs = [('All Provinces', 'All Regions')]
+    for prov in data.case_index.provinces:
+        pairs += [(prov, region) for region in ['All Regions'] + data.case_index.regions.get(prov, [])]
+    return pairs
+
+
+def render_selection(data, prov, region):
+    return (*keycards(data.cases_cube, prov, region),
+            agegender_figure(data.cases_cube, prov, region),
+            death_figure(data.deaths_cube, prov, region))
+
+
+def default_case_figure(data, prov, region):
+    return case_figure(data.cases_series, prov, region)
+
+
+def first_case_page(data, prov, region):
+    return case_table(data, prov, region, 0, table_page_size, [], '')
+
+
+def first_death_page(data, prov, region):
+    return death_table(data, prov, region, 0, table_page_size, [], '')
+
+
+payload_cache.register('selection', render_selection, selections)
+payload_cache.register('case-graph', default_case_figure, selections)
+payload_cache.register('cases-table', first_case_page, selections)
+payload_cache.register('deaths-table', first_death_page, selections)
+
+
+# Cases Table (only the visible page is sent)
+@app.callback(
+    [Output('filtered-datatable', 'data'), Output('filtered-datatable', 'page_count')],
+    [Input('Province', 'value'), Input('Region', 'value'),
+     Input('filtered-datatable', 'page_current'), Input('filtered-datatable', 'page_size'),
+     Input('filtered-datatable', 'sort_by'), Input('filtered-datatable', 'filter_query')])
+@memoize
+def update_table(prov, region, page_current, page_size, sort_by, filter_query):
+    if is_first_page(page_current, page_size, sort_by, filter_query):
+        return payload_cache.decoded('cases-table', prov, region)
+    return case_table(store.get(), prov, region, page_current, page_size, sort_by, filter_query)
+
+
+# Deaths Table (only the visible page is sent)
+@app.callback(
+    [Output('death-df', 'data'), Output('death-df', 'page_count')],
+    [Input('Province', 'value'), Input('Region', 'value'),
+     Input('death-df', 'page_current'), Input('death-df', 'page_size'),
+     Input('death-df', 'sort_by'), Input('death-df', 'filter_query')])
+@memoize
+def update_deathstable(prov, region, page_current, page_size, sort_by, filter_query):
+    if is_first_page(page_current, page_size, sort_by, filter_query):
+        return payload_cache.decoded('deaths-table', prov, region)
+    return death_table(store.get(), prov, region, page_current, page_size, sort_by, filter_query)
+
+
+# Cases by date over the picked window (default: the latest days)
+@app.callback(
+    Output('funnel-graph', 'figure'),
+    [Input('Province', 'value'), Input('Region', 'value'),
+     Input('date-range', 'start_date'), Input('date-range', 'end_date'), Input('series-kind', 'value')])
+@memoize
+def update_case_graph(prov, region, start_date, end_date, kind):
+    if start_date is None and end_date is None and kind == 'daily':
+        return payload_cache.decoded('case-graph', prov, region)
+    return case_figure(store.get().cases_series, prov, region, start_date, end_date, kind)
+
+
+# Everything else that only depends on the selection, in one round trip
+@app.callback(
+    [Output("canadatext_subtitle", "children"),
+     Output("provtext_subtitle", "children"),
+     Output("reg_total", "children"),
+     Output("agegender-graph", "figure"),
+     Output('death-graph', 'figure')],
+    [Input('Province', 'value'), Input('Region', 'value')])
+def update_selection(prov, region):
+    # Already rendered to JSON for this data version, so only the decode is left
+    return payload_cache.decoded('selection', prov, region)
+
+
+# Pre-rendered payloads as stored, e.g. /payloads/selection?province=Ontario&region=Toronto
+@server.route('/payloads/<name>')
+def payload(name):
+    if name not in ['selection', 'case-graph', 'cases-table', 'deaths-table']:
+        flask.abort(404)
+    body = payload_cache.get(name, flask.request.args.get('province', 'All Provinces'),
+                             flask.request.args.get('region', 'All Regions'))
+    response = flask.Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Already gzipped, so Flask-Compress leaves it alone
+    if 'gzip' in flask.request.headers.get('Accept-Encoding', ''):
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response.set_data(gzip.decompress(body))
+    return response
+
+
+# Streaming CSV/Arrow extracts of a selection, under /api/export
+server.register_blueprint(export_blueprint(store.get))
+
+
+# Hit/miss counters of the callback cache
+@server.route('/cache-stats')
+def cache_stats():
+    return flask.jsonify(dict(callback_cache.info(), payloads=payload_cache.info()))
+
+
+# Time, size and rows of every callback request, plus the opt-in sampling profiler
+@server.before_request
+def start_request():
+    flask.g.start = perf_counter()
+    metrics.start_request()
+    if metrics.profiling_enabled and '1' in [flask.request.args.get('profile'), flask.request.headers.get('X-Profile')]:
+        flask.g.sampler = metrics.Sampler(threading.get_ident()).start()
+
+
+def callback_name():
+    ''' Name of the function behind a Dash callback request.'''
+    body = flask.request.get_json(silent=True) or {}
+    callback = app.callback_map.get(body.get('output'), {}).get('callback')
+    return getattr(callback, '__name__', 'unknown')
+
+
+@server.after_request
+def record_request(response):
+    is_callback = flask.request.path.endswith('_dash-update-component')
+    name = callback_name() if is_callback else None
+    if is_callback:
+        # Flask-Compress runs after this, so the size is before compression
+        metrics.callback_seconds.observe(perf_counter() - flask.g.start, callback=name)
+        metrics.callback_bytes.observe(response.calculate_content_length() or 0, callback=name)
+        metrics.callback_rows.observe(metrics.request_rows(), callback=name)
+        if response.status_code >= 400:
+            metrics.callback_errors.inc(callback=name)
+
+    sampler = flask.g.pop('sampler', None)
+    if sampler is not None:
+        sampler.stop()
+        metrics.profiles.append({'path': flask.request.path, 'callback': name, 'seconds': sampler.seconds,
+                                 'samples': sum(sampler.stacks.values()), 'folded': sampler.folded()})
+        response.headers['X-Profile-Samples'] = str(metrics.profiles[-1]['samples'])
+    return response
+
+
+# Prometheus scrape endpoint
+@server.route('/metrics')
+def metrics_endpoint():
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Folded stacks of the latest profiled requests (COVID_PROFILING=1, then add ?profile=1 or X-Profile: 1)
+@server.route('/profiles')
+def profiles():
+    text = ''.join(f"# {p['path']} {p['callback'] or ''} {p['seconds'] * 1000:.1f} ms, {p['samples']} samples\n"
+                   f"{p['folded']}\n\n" for p in reversed(metrics.profiles))
+    return flask.Response(text, mimetype='text/plain')
+
+
+app.layout = serve_layout
+payload_cache.start_prerender()
+metrics.startup_seconds.set(perf_counter() - started, stage='serve')
+print(f'Ready to serve after {perf_counter() - started:.2f} s')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+import os
+import threading
+from collections import namedtuple
+from time import perf_counter
+from get_covid_data_from_url import get_covid_data, covid_case_url, last_source, last_timings
+from aggregates import build_cube, build_geo_index
+from timeseries import build_series
+import metrics
+
+# Seconds between background refreshes (0 turns the refresher off)
+refresh_interval = int(os.environ.get('COVID_REFRESH_INTERVAL', 3600))
+
+# Load once in one worker and share it with the others (see shared_data.py)
+shared_data_enabled = os.environ.get('COVID_SHARED_DATA', '0') == '1'
+
+# Everything a callback needs from one data load. Swapped as a whole so callbacks never mix versions.
+Dataset = namedtuple('Dataset', ['df', 'deaths', 'update_date', 'version', 'cases_cube', 'deaths_cube',
+                                 'case_text', 'death_text', 'case_index', 'death_index',
+                                 'cases_series'])
+
+# Free text only the tables show, kept out of the frames the charts scan
+long_text_cols = ['additional_info']
+
+
+def split_text(frame):
+    text_cols = frame.columns.intersection(long_text_cols)
+    return frame.drop(columns=text_cols), frame[text_cols]
+
+
+def memory_report(data):
+    ''' Rows and deep memory use of each frame in a Dataset.'''
+    frames = [('cases', data.df), ('case text', data.case_text),
+              ('deaths', data.deaths), ('death text', data.death_text)]
+    return '\n'.join(f'{name}: {len(x):,} rows, {x.memory_usage(deep=True).sum() / 2 ** 20:.1f} MB'
+                     for name, x in frames)
+
+
+class DataStore:
+    ''' Holds the current Dataset and refreshes it in the background.'''
+
+    def __init__(self):
+        self._data = None
+        self._key = None
+        # Hashes of the current frames' rows as parsed, when they were cleaned rather than read from a snapshot
+        self._row_hashes = None
+        # (path, hash) of the workbook last fetched
+        self._source = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+
+    def get(self):
+        ''' The current Dataset, waiting for the first load if it is still running.'''
+        if self._data is None:
+            self._ready.wait()
+        return self._data
+
+    def load(self, method_='url'):
+        ''' Fetch the workbook and swap in the new frames. Returns True if the data changed.'''
+        with self._lock:
+            fetched = self._fetch(method_)
+            if fetched is None:
+                return False
+            self.swap(*fetched)
+            return True
+
+    def _fetch(self, method_):
+        ''' Fetch and clean the workbook, reusing the current frames' age groups. Returns the arguments of swap(),
+        or None if the data is unchanged. Call with the lock held.'''
+        current = self._data
+        previous = None
+        if current is not None and self._row_hashes is not None:
+            previous = (current.df.join(current.case_text), current.deaths.join(current.death_text),
+                        *self._row_hashes)
+        current_key = self._key if current is not None else None
+        # The file only stands for the current data if that is what was last fetched
+        current_path = self._source[0] if self._source and self._source[1] == current_key else None
+        fetched = get_covid_data(covid_case_url, method_=method_, previous=previous,
+                                 current_key=current_key, current_path=current_path)
+        for stage, seconds in last_timings.items():
+            metrics.load_seconds.observe(seconds, stage=stage)
+
+        if fetched is None and last_source.get('key') == current_key:
+            # Same workbook under another file, which later 304s can now vouch for
+            self._source = (last_source['path'], current_key)
+        if fetched is None or current is not None and last_source['fallback']:
+            # Unchanged, or the download failed and we'd only fall back to the older local file
+            metrics.loads.inc(changed='no')
+            return None
+        metrics.loads.inc(changed='yes')
+        self._row_hashes = last_source.get('row_hashes')
+        self._source = (last_source['path'], last_source['key'])
+        df, deaths, update_date = fetched
+
+        df, case_text = split_text(df)
+        deaths, death_text = split_text(deaths)
+        return df, deaths, case_text, death_text, update_date, last_source['key']
+
+    def swap(self, df, deaths, case_text, death_text, update_date, key, version=None):
+        ''' Build the aggregates for new frames and make them current.'''
+        current = self._data
+        if version is None:
+            version = 1 if current is None else current.version + 1
+        self._data = Dataset(df, deaths, update_date, version,
+                             build_cube(df, 'provincial_case_id'),
+                             build_cube(deaths, 'death_id'),
+                             case_text, death_text,
+                             build_geo_index(df), build_geo_index(deaths),
+                             build_series(df, 'provincial_case_id', 'date_report'))
+        self._key = key
+        self._ready.set()
+        metrics.data_version.set(version)
+        for name, frame in [('cases', df), ('deaths', deaths)]:
+            metrics.data_rows.set(len(frame), frame=name)
+
+    def load_in_background(self, method_='url', started=None):
+        ''' Load from the local workbook (its snapshot if there is one), then from method_, and keep refreshing,
+        all in a thread. get() waits for the first load. started: perf_counter() the startup time is counted from.'''
+        thread = threading.Thread(target=self._background_load, args=(method_, started or perf_counter()),
+                                  name='data-loader', daemon=True)
+        thread.start()
+        return thread
+
+    def _background_load(self, method_, started):
+        waiting = True
+        for source in ['cached', method_] if method_ != 'cached' else ['cached']:
+            try:
+                self.load(method_=source)
+            except Exception as e:
+                # Fall through to the next source, or to the refresher if this was the last
+                print(f'Data load ({source}) failed: {e}')
+            if waiting and self._data is not None:
+                waiting = False
+                metrics.startup_seconds.set(perf_counter() - started, stage='first_data')
+                print(f'First data after {perf_counter() - started:.2f} s\n{memory_report(self._data)}')
+        self.start_refresher()
+
+    def start_refresher(self, interval=refresh_interval):
+        if interval <= 0:
+            return
+        thread = threading.Thread(target=self._refresh_loop, args=(interval,), name='data-refresher', daemon=True)
+        thread.start()
+
+    def stop_refresher(self):
+        self._stop.set()
+
+    def _refresh_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                if self.load():
+                    print(f'Data refreshed: {self._data.update_date}')
+            except Exception as e:
+                # Keep serving the current data and try again next time
+                print(f'Data refresh failed: {e}')
@@ -0,0 +1,162 @@
+import os
+import threading
+import flask
+import pandas as pd
+from aggregates import all_provinces, all_regions, selection_key
+from get_covid_data_from_url import keep_cols, keep_cols_death
+import metrics
+
+# Read-only slices of the current frames, e.g.
+#   /api/export?table=cases&province=Ontario&region=Toronto&start=2020-03-01&end=2020-03-31&format=csv
+# Rows are streamed a chunk at a time straight from the in-memory frames, so an extract of any size takes
+# about one chunk of memory, and only export_concurrency run at once so they can't crowd out the dashboard.
+# That needs threaded workers (gthread in the Procfile) with more threads than export_concurrency: a sync worker
+# would be held by one download for as long as the client takes to read it.
+export_chunk_rows = int(os.environ.get('COVID_EXPORT_CHUNK_ROWS', 10_000))
+export_concurrency = int(os.environ.get('COVID_EXPORT_CONCURRENCY', 2))
+
+# table: (frame, text frame, row index, date column, columns) of a Dataset
+tables = {'cases': ('df', 'case_text', 'case_index', 'date_report', keep_cols + ['age_order']),
+          'deaths': ('deaths', 'death_text', 'death_index', 'date_death_report', keep_cols_death + ['age_order'])}
+mimetypes = {'csv': 'text/csv', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+rows_exported = metrics.counter('covid_export_rows_total', 'Rows streamed by the export API')
+
+
+def parse_date(value, name):
+    if not value:
+        return None
+    try:
+        return pd.Timestamp(value)
+    except ValueError:
+        flask.abort(400, f'{name} must be a date like 2020-03-31')
+
+
+def row_chunks(data, table, prov, region, start, end):
+    ''' Yield the selection's rows between start and end, export_chunk_rows frame rows at a time.'''
+    frame_name, text_name, index_name, date_col, columns = tables[table]
+    frame, text = getattr(data, frame_name), getattr(data, text_name)
+    if prov == all_provinces:
+        # Slices of the whole frame, so no row positions are built
+        positions = [slice(i, i + export_chunk_rows) for i in range(0, len(frame), export_chunk_rows)]
+    else:
+        rows = getattr(data, index_name).rows.get(selection_key(prov, region), [])
+        positions = [rows[i:i + export_chunk_rows] for i in range(0, len(rows), export_chunk_rows)]
+
+    for rows in positions:
+        chunk, text_chunk = frame.iloc[rows], text.iloc[rows]
+        if start is not None or end is not None:
+            dates = chunk[date_col]
+            keep = dates.notna()
+            if start is not None:
+                keep &= dates >= start
+            if end is not None:
+                keep &= dates <= end
+            chunk, text_chunk = chunk[keep.values], text_chunk[keep.values]
+        if len(chunk):
+            yield pd.concat([chunk, text_chunk], axis=1)[columns]
+
+
+def csv_stream(chunks, columns):
+    header = True
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=header, date_format='%Y-%m-%d')
+        header = False
+    if header:
+        # No rows: just the header
+        yield ','.join(columns) + '\n'
+
+
+class ChunkSink:
+    ''' Write-only file that hands back whatever was written since the last take().'''
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        out = b''.join(self.parts)
+        self.parts = []
+        return out
+
+
+def arrow_stream(chunks, schema_frame):
+    ''' An Arrow IPC stream with one record batch per chunk. schema_frame: any frame with the columns and types.'''
+    import pyarrow as pa
+    # Text columns with no rows to go by come out as null, make them strings
+    schema = pa.schema([pa.field(f.name, pa.string()) if f.type == pa.null() else f
+                        for f in pa.Schema.from_pandas(schema_frame, preserve_index=False)])
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+    yield sink.take()
+    for chunk in chunks:
+        writer.write_batch(pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def export_blueprint(get_data):
+    ''' The export API, for a function returning the current Dataset.'''
+    blueprint = flask.Blueprint('export', __name__, url_prefix='/api')
+    slots = threading.BoundedSemaphore(export_concurrency)
+
+    @blueprint.route('/export')
+    def export():
+        args = flask.request.args
+        table, format_ = args.get('table', 'cases'), args.get('format', 'csv')
+        if table not in tables:
+            flask.abort(400, f'table must be one of {", ".join(tables)}')
+        if format_ not in mimetypes:
+            flask.abort(400, f'format must be one of {", ".join(mimetypes)}')
+        prov, region = args.get('province', all_provinces), args.get('region', all_regions)
+        start, end = parse_date(args.get('start'), 'start'), parse_date(args.get('end'), 'end')
+        if not slots.acquire(blocking=False):
+            response = flask.Response('Too many exports running, try again shortly\n', status=503,
+                                      mimetype='text/plain')
+            response.headers['Retry-After'] = '5'
+            return response
+
+        try:
+            # Holding on to this Dataset keeps the extract consistent if the data is refreshed meanwhile
+            data = get_data()
+
+            def counted(chunks):
+                for chunk in chunks:
+                    rows_exported.inc(len(chunk), table=table, format=format_)
+                    yield chunk
+
+            chunks = counted(row_chunks(data, table, prov, region, start, end))
+            frame_name, text_name, index_name, date_col, columns = tables[table]
+            if format_ == 'csv':
+                body = csv_stream(chunks, columns)
+            else:
+                schema_frame = pd.concat([getattr(data, frame_name).iloc[:0], getattr(data, text_name).iloc[:0]],
+                                         axis=1)[columns]
+                body = arrow_stream(chunks, schema_frame)
+            response = flask.Response(body, mimetype=mimetypes[format_])
+            response.headers['Content-Disposition'] = f'attachment; filename=covid-{table}.{format_}'
+            response.headers['X-Data-Version'] = str(data.version)
+            # Free the slot when the download ends, however it ends
+            response.call_on_close(slots.release)
+        except:
+            slots.release()
+            raise
+        return response
+
+    return blueprint
@@ -0,0 +1,171 @@
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from time import perf_counter
+import requests
+
+# Downloaded workbooks, one file per URL, plus the ETag/Last-Modified the server sent for each.
+# An interrupted download is kept as <workbook>.part and resumed with a Range request if the server's
+# validator for it still matches.
+download_dir = r'Data/cache'
+validators_name = 'validators.json'
+
+# Seconds a download may take in total, including a server that trickles the body
+fetch_timeout = int(os.environ.get('COVID_FETCH_TIMEOUT', 10))
+# Seconds from the start a backup that finished first waits for a healthy primary, so refreshes don't flip
+# between the two copies
+primary_grace = float(os.environ.get('COVID_PRIMARY_GRACE', 3))
+
+# xlsx files are zip archives
+workbook_magic = b'PK\x03\x04'
+chunk_size = 1 << 16
+
+# One pooled session for every fetch, so repeat downloads reuse the TLS connection
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+_validators_lock = threading.Lock()
+
+
+def download_path(url, dest_dir=download_dir):
+    return os.path.join(dest_dir, hashlib.sha1(url.encode()).hexdigest()[:16] + '.xlsx')
+
+
+def read_validators(dest_dir=download_dir):
+    try:
+        with open(os.path.join(dest_dir, validators_name)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_validators(url, validators, dest_dir=download_dir):
+    with _validators_lock:
+        stored = read_validators(dest_dir)
+        stored[url] = validators
+        path = os.path.join(dest_dir, validators_name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(stored, f)
+        os.replace(tmp_path, path)
+
+
+def resume_validator(headers):
+    ''' The If-Range value for a response's body: a strong ETag, else Last-Modified.'''
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def open_part(path):
+    ''' The partial download of path, locked for this fetch, and whether it can be resumed.
+    If another fetch holds it, a private file that is never resumed.'''
+    f = open(f'{path}.part', 'ab')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return f, True
+    except OSError:
+        f.close()
+        return open(f'{path}.{os.getpid()}-{threading.get_ident()}.part', 'wb'), False
+
+
+def fetch_workbook(url, dest_dir=download_dir, timeout=fetch_timeout):
+    ''' Stream url to a file under dest_dir. Returns (path, changed).
+    changed is False when the server answers 304 for the copy already on disk.
+    A download cut short is resumed from where it stopped by the next call.
+    Raises if the request fails, runs past timeout or the body is not an xlsx file.'''
+    deadline = perf_counter() + timeout
+    path = download_path(url, dest_dir)
+    headers = {}
+    if os.path.exists(path):
+        validators = read_validators(dest_dir).get(url, {})
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    # Write next to the target and rename, so a failed or raced download never leaves half a workbook
+    f, resumable = open_part(path)
+    keep = done = False
+    try:
+        offset = os.fstat(f.fileno()).st_size
+        partial = read_validators(dest_dir).get(f'{url} partial') if resumable and offset else None
+        if partial:
+            # The server sends the rest if the file is unchanged, otherwise all of it
+            headers.update({'Range': f'bytes={offset}-', 'If-Range': partial})
+
+        with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+            if response.status_code == 304 and ('If-None-Match' in headers or 'If-Modified-Since' in headers):
+                keep = resumable
+                return path, False
+            response.raise_for_status()
+            if response.status_code == 206:
+                if not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                    raise ValueError(f'{url} sent a different range than asked for')
+            else:
+                f.seek(0)
+                f.truncate()
+                if resumable:
+                    save_validators(f'{url} partial', resume_validator(response.headers), dest_dir)
+
+            # Whatever arrives is kept for the next call, unless the server turns out not to send a workbook
+            keep = resumable
+            for chunk in response.iter_content(chunk_size):
+                if perf_counter() > deadline:
+                    raise requests.Timeout(f'{url} took longer than {timeout}s')
+                f.write(chunk)
+            f.flush()
+            with open(f.name, 'rb') as written:
+                if written.read(len(workbook_magic)) != workbook_magic:
+                    keep = False
+                    raise ValueError(f'{url} did not return an xlsx workbook')
+            os.replace(f.name, path)
+            done = True
+
+        save_validators(url, {'etag': response.headers.get('ETag'),
+                              'last_modified': response.headers.get('Last-Modified')}, dest_dir)
+    finally:
+        # Removed before closing, while this fetch still holds the lock
+        f.flush()
+        if not done and os.path.exists(f.name) and (not keep or os.fstat(f.fileno()).st_size == 0):
+            os.remove(f.name)
+        f.close()
+    return path, True
+
+
+def fetch_first(urls, dest_dir=download_dir, timeout=fetch_timeout, grace=primary_grace):
+    ''' Fetch all urls at once and return (path, url, changed) for the first valid workbook.
+    urls[0] is the primary: another url only wins if the primary fails or is still running grace seconds in.
+    Raises IOError if none arrive within timeout.'''
+    start = perf_counter()
+    os.makedirs(dest_dir, exist_ok=True)
+    pool = ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix='fetch')
+    futures = {pool.submit(fetch_workbook, url, dest_dir, timeout): url for url in urls}
+    primary = next(iter(futures))
+    errors = []
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            try:
+                path, changed = future.result()
+            except Exception as e:
+                errors.append(f'{futures[future]}: {e}')
+                continue
+            if future is not primary:
+                try:
+                    path, changed = primary.result(timeout=max(0, min(grace, timeout) - (perf_counter() - start)))
+                    future = primary
+                except Exception:
+                    # Failed or still running: the backup stands
+                    pass
+            return path, futures[future], changed
+    except TimeoutError:
+        errors.append(f'timed out after {timeout}s')
+    finally:
+        # Losers finish (or time out) in the background; their files are written atomically
+        pool.shutdown(wait=False)
+    raise IOError('No workbook downloaded: ' + '; '.join(errors))
@@ -1,43 +1,56 @@
 from numpy import nan
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
 import re
 
+# First run of digits in an age string, e.g. '>70' -> '70'
+first_number = re.compile('([0-9]+)')
+
+
+def rangeify(nums):
+    ''' Takes in an array of integers and outputs ranges, e.g. 47 -> '40-49' '''
+    floors = pd.Series(np.floor_divide(nums, 10) * 10, dtype='int64')
+    return (floors.astype(str) + '-' + (floors + 9).astype(str)).to_numpy(dtype=object)
+
+
+def group_strings(labels):
+    ''' Vectorized string rules of group_age over a Series of distinct age strings.'''
+    grouped = labels.to_numpy(dtype=object)
+    num = pd.to_numeric(labels.str.extract(first_number, expand=False)).to_numpy(dtype=float)
+    has_num = ~np.isnan(num)
+    over = labels.str.contains('>', regex=False).to_numpy(dtype=bool)
+
+    # e.g. ">70" -> '70-79'
+    grouped[over & has_num] = rangeify(num[over & has_num])
+    grouped[over & ~has_num] = ''
+    # e.g. '10-19' or '<10'
+    grouped[~over & has_num & (num < 20)] = '<20'
+    return grouped
+
+
 def group_age(input_column):
     ''' If input age is an integer, it groups it correctly. Otherwise, fixes string.'''
-    output_column = []
-
-    def rangeify(z):
-        # Takes in integer and outputs range
-        flr = int(round(z - 4.5, -1))
-        clg = flr + 9
-        return f'{flr}-{clg}'
-
-    for y in input_column:
-        try:
-            if type(y) == int:
-                if y < 20:
-                    output_column.append('<20')
-                else:
-                    output_column.append(rangeify(y))
-            elif '>' in y:
-                # e.g. ">70"
-                num = int(re.findall("[0-9]+", y)[0])
-                output_column.append(rangeify(num))
-            elif (y not in order_dict.keys()) or ('<' in y):
-                # e.g. '10-19' or '<10'
-                try:
-                    first_num = int(re.findall('[0-9]+', y)[0])
-                    if first_num < 20:
-                        output_column.append('<20')
-                    else:
-                        output_column.append(y) # may need fixing
-                except:
-                    output_column.append(y)
-                    pass
-            else:
-                output_column.append(y)
-        except:
-            output_column.append('')
-    return output_column
+    ages = pd.Series(input_column)
+    values = ages.to_numpy(dtype=object)
+
+    # Ages only take a handful of distinct values, so group those and broadcast back.
+    # Missing values get code -1, which picks the trailing '' slot.
+    codes, labels = pd.factorize(values)
+    labels = pd.Series(labels, dtype=object)
+    is_str = np.append((labels.map(type) == str).to_numpy(), True)
+    grouped = np.full(len(labels) + 1, '', dtype=object)  # anything else (floats, dates) -> ''
+    grouped[:-1][is_str[:-1]] = group_strings(labels[is_str[:-1]])
+    output_column = grouped[codes]
+
+    # 1, 1.0 and True share a label, so check the type of each non-string row; only integers are grouped
+    others = np.flatnonzero(~is_str[codes])
+    kinds = pd.Series(values[others]).map(type).to_numpy()
+    others = others[kinds == int]
+    nums = values[others].astype('int64')
+    output_column[others] = np.where(nums < 20, '<20', rangeify(nums))
+    return pd.Series(output_column, index=ages.index)
+
 
 order_dict = {
         '<20': 1,
@@ -54,17 +67,45 @@ order_dict = {
         '': 12
     }
 inv_dict = {v: k for k, v in order_dict.items()}
+order_values = np.array(list(order_dict.values()))
+
 
 def order_agegroups(input_column):
     ''' Input age column and output an ordered one'''
-    output_column = []
-    for i in input_column:
-        try:
-            output_column.append(order_dict[i])
-        except:
-            output_column.append(nan)
-
+    ages = pd.Series(input_column)
+    codes = pd.Categorical(ages.to_numpy(dtype=object), categories=list(order_dict)).codes
+    output_column = pd.Series(order_values[codes], index=ages.index)
+    if (codes < 0).any():
+        # Unknown groups
+        output_column = output_column.where(codes >= 0, nan)
     return output_column
 
+
 def inverse_order_dict(input_val):
     return inv_dict[input_val]
+
+
+# Low-cardinality text columns, stored as categoricals
+category_cols = ['province', 'health_region', 'sex', 'age', 'travel_yn', 'travel_history_country']
+
+
+def compact_frame(x):
+    ''' Shrink a cleaned case or death frame: categorical text, small integer ids and age_order.
+    age_order becomes int8 with 0 for unknown age groups (previously NaN).'''
+    for col in x.columns.intersection(category_cols):
+        x[col] = x[col].astype('category')
+    x['age_order'] = x['age_order'].fillna(0).astype('int8')
+    for col in x.columns.intersection(['provincial_case_id', 'death_id']):
+        x[col] = pd.to_numeric(x[col], downcast='integer')
+    return x
+
+
+def concat_compact(frames):
+    ''' Append compacted frames. pd.concat falls back to object unless every frame has the same categories,
+    so the categorical columns are merged with union_categoricals.'''
+    columns = frames[0].columns
+    cat_cols = columns.intersection(category_cols)
+    out = pd.concat([x.drop(columns=cat_cols) for x in frames], ignore_index=True, sort=False)
+    for col in cat_cols:
+        out[col] = union_categoricals([x[col] for x in frames], sort_categories=True)
+    return out[columns]
@@ -1,72 +1,250 @@
-import requests
+import os
 import pandas as pd
 from datetime import datetime
-import eventlet
+import numpy as np
+from numpy import nan
+from time import perf_counter
+from format_data import group_age, order_agegroups, compact_frame, concat_compact
+from snapshot import content_hash, load_snapshot, save_snapshot
 
 # Get data
 covid_case_url = r'https://docs.google.com/spreadsheets/d/1D6okqtBS3S2NRC7GFVHzaZ67DuTw7LX49-fqSLwJyeo/export?format=xlsx'
 backup_url = r'https://docs.google.com/spreadsheets/d/11z8MF7UTt3_EraMvPF4IilVZHL6cwM6t/export?format=xlsx'
-
-
-
-def get_covid_data(covid_case_url, method_='url'):
-    # Initiate eventlet to manage request timeout
-    eventlet.monkey_patch()
-
-    if method_ == 'url':
-        try:
-            with eventlet.timeout.Timeout(10):
-                s = requests.get(covid_case_url).content
-                BytesIO = pd.io.common.BytesIO  # Wrap in BytesIO to make it a file-like object
-                s = BytesIO(s)
-                filesource_caveat = ''
-        except:
-            try:
-                with eventlet.timeout.Timeout(10):
-                    s = requests.get(backup_url).content
-                    BytesIO = pd.io.common.BytesIO  # Wrap in BytesIO to make it a file-like object
-                    s = BytesIO(s)
-                    filesource_caveat = ' [cached].'
-            except:
-                s = r'Data/Public_COVID-19_Canada.xlsx'
-                filesource_caveat = ' [cached]'
-    else:
-        s = r'Data/Public_COVID-19_Canada.xlsx'
-        filesource_caveat = ' [cached]'
-
-    # Update Date
-    update_date = pd.read_excel(s, sheet_name='Cases', index_col=None, header=None, nrows=1, engine='xlrd')
-    update_date = str(update_date.iloc[0, 0])[13:]+filesource_caveat
-
-
-    # Cases Data
-    df = pd.read_excel(s, sheet_name='Cases', index_col=None, skiprows=3, header=0, engine='xlrd')
-
+local_path = r'Data/Public_COVID-19_Canada.xlsx'
+
+# Keep only key columns
+keep_cols = ['provincial_case_id', 'age', 'sex', 'health_region', 'province', 'date_report', 'report_week',
+             'travel_yn', 'travel_history_country', 'additional_info']
+keep_cols_death = ['death_id', 'age', 'sex', 'health_region', 'province', 'date_death_report',
+                   'additional_info']
+text_cols = ['sex', 'health_region', 'province', 'travel_yn', 'travel_history_country', 'additional_info']
+date_cols = ['date_report', 'report_week', 'date_death_report']
+
+# Rows per chunk when streaming the sheets (0 reads them whole). Peak memory follows the chunk, not the sheet.
+ingest_chunksize = int(os.environ.get('COVID_INGEST_CHUNKSIZE', 0))
+# Processes that parse and clean the sheets in parallel, the Cases sheet split in as many parts (0 turns it off)
+ingest_workers = int(os.environ.get('COVID_INGEST_WORKERS', 0))
+
+# Seconds spent in each stage of the latest get_covid_data call
+last_timings = {}
+# Workbook file and hash, whether the local file was used as a fallback and the row hashes (see clean_rows),
+# for the latest call
+last_source = {}
+
+
+def read_workbook(s):
+    ''' Open the workbook once and parse the update date, Cases and Mortality sheets (key columns only).'''
+    with pd.ExcelFile(s, engine='xlrd') as xl:
+        update_date = xl.parse('Cases', index_col=None, header=None, nrows=1)
+        df = xl.parse('Cases', index_col=None, skiprows=3, header=0, usecols=keep_cols)
+        deaths = xl.parse('Mortality', index_col=None, skiprows=3, header=0, usecols=keep_cols_death)
+    update_date = str(update_date.iloc[0, 0])[13:]
+
+    # usecols keeps sheet order, so restore ours
+    return update_date, df[keep_cols], deaths[keep_cols_death]
+
+
+def sheet_frame(chunk, columns):
+    ''' A frame of row tuples read from part of a sheet.'''
+    x = pd.DataFrame(chunk, columns=columns)
+    # An all-blank column in one chunk would otherwise come out as float and spoil the concat
+    for col in x.columns.intersection(text_cols):
+        x[col] = x[col].astype(object)
+    for col in x.columns.intersection(date_cols):
+        if x[col].isna().all():
+            x[col] = pd.to_datetime(x[col])
+    return x
+
+
+def iter_sheet(wb, sheet, columns, chunksize):
+    ''' Yield frames of up to chunksize rows of an openpyxl read-only sheet, keeping only columns.'''
+    rows = wb[sheet].iter_rows(min_row=4, values_only=True)
+    header = next(rows)
+    positions = [header.index(col) for col in columns]
+
+    chunk = []
+    for row in rows:
+        # Match read_excel: blank cells are NaN and whole numbers are ints
+        values = tuple(nan if i >= len(row) or row[i] is None
+                       else int(row[i]) if isinstance(row[i], float) and row[i].is_integer()
+                       else row[i] for i in positions)
+        if all(v is nan for v in values):
+            continue
+        chunk.append(values)
+        if len(chunk) == chunksize:
+            yield sheet_frame(chunk, columns)
+            chunk = []
+    if chunk:
+        yield sheet_frame(chunk, columns)
+
+
+def filter_cases(df):
     # Jan 1st onwards
     df = df.loc[df['date_report'] >= datetime.strptime('2020-01-01', '%Y-%m-%d')]
 
     # Remove repatriated (cruise ships)
-    df = df.loc[df['province'] != 'Repatriated']
+    return df.loc[df['province'] != 'Repatriated']
 
-    # Keep only key columns
-    keep_cols = ['provincial_case_id', 'age', 'sex', 'health_region', 'province', 'date_report', 'report_week',
-                 'travel_yn', 'travel_history_country', 'additional_info']
-
-    df = df[keep_cols]
-
-
-    # Deaths
-    deaths = pd.read_excel(s, sheet_name='Mortality', index_col=None, skiprows=3, header=0, engine='xlrd')
-    keep_cols_death = ['death_id', 'age', 'sex', 'health_region', 'province', 'date_death_report',
-                       'additional_info']
-    deaths = deaths[keep_cols_death]
-
-    # Format datetime
-    deaths['date_death_report'] = deaths['date_death_report'].dt.strftime('%d-%m-%Y')
-
-    deaths.sort_values('date_death_report', ascending=False, inplace=True)
 
+def filter_deaths(deaths):
     # Remove repatriated (cruise ships)
-    deaths = deaths.loc[deaths['province'] != 'Repatriated']
-
-    return df, deaths, update_date
+    return deaths.loc[deaths['province'] != 'Repatriated']
+
+
+def read_workbook_chunked(s, chunksize):
+    ''' Stream the Cases and Mortality sheets in chunks of rows, filtering, cleaning and compacting each chunk
+    before appending it. Returns the update date and the compacted frames.'''
+    # Imported here so that starting from a snapshot never loads it
+    import openpyxl
+    wb = openpyxl.load_workbook(s, read_only=True)
+    try:
+        update_date = str(next(wb['Cases'].iter_rows(max_row=1, values_only=True))[0])[13:]
+        frames = []
+        for sheet, columns, filter_ in [('Cases', keep_cols, filter_cases),
+                                        ('Mortality', keep_cols_death, filter_deaths)]:
+            parts = [compact_frame(clean_frame(filter_(chunk))) for chunk in iter_sheet(wb, sheet, columns, chunksize)]
+            frames.append(concat_compact(parts))
+    finally:
+        wb.close()
+    df, deaths = frames
+
+    # Most recent first
+    deaths = deaths.sort_values('date_death_report', ascending=False).reset_index(drop=True)
+    return update_date, df, deaths
+
+
+def clean_text(x):
+    # Some text columns mix in numbers (e.g. travel_yn), keep them as strings
+    for col in x.columns.intersection(text_cols):
+        x[col] = x[col].where(x[col].isna(), x[col].astype(str))
+    return x
+
+
+def clean_frame(x):
+    ''' Group ages and normalise text columns of freshly parsed rows.'''
+    x = x.reset_index(drop=True)
+    x['age'] = group_age(x['age'])
+    x['age_order'] = order_agegroups(x['age'])
+    return clean_text(x)
+
+
+def row_hashes(x):
+    ''' One 64-bit hash of each row over all its values. Mixed object columns also hash each value's type,
+    since 47 and '47' hash alike but are grouped differently.'''
+    mixed = [col for col in x.columns.difference(text_cols) if x[col].dtype == object]
+    types = pd.DataFrame({f'{col} type': x[col].map(type).astype(str) for col in mixed}, index=x.index)
+    return pd.util.hash_pandas_object(pd.concat([x, types], axis=1), index=False).values
+
+
+def clean_rows(fresh, previous=None):
+    ''' clean_frame, also returning the hashes of the rows as parsed for the next call.
+    previous: (cleaned frame, its row hashes) from an earlier call. Rows identical to one of its rows in every
+    column take their age group from it instead of being grouped again.'''
+    x = clean_text(fresh.reset_index(drop=True))
+    hashes = row_hashes(x)
+    age = x['age'].to_numpy(dtype=object).copy()
+    known = np.zeros(len(x), dtype=bool)
+    if previous is not None and len(previous[1]):
+        frame, previous_hashes = previous
+        order = np.argsort(previous_hashes)
+        i = order[np.minimum(np.searchsorted(previous_hashes[order], hashes), len(order) - 1)]
+        known = previous_hashes[i] == hashes
+        age[known] = frame['age'].to_numpy(dtype=object)[i[known]]
+    age[~known] = group_age(x['age'][~known]).to_numpy()
+    x['age'] = age
+    x['age_order'] = order_agegroups(x['age'])
+    return x, hashes
+
+
+def process_workbook(s, previous=None, chunksize=0, workers=0):
+    ''' Parse, filter and clean a workbook into compacted cases and deaths. Returns (update_date, df, deaths).'''
+    parsed = None
+    if workers:
+        from parallel_ingest import read_workbook_parallel
+        start = perf_counter()
+        parsed = read_workbook_parallel(s, workers)
+        last_timings['parse'] = perf_counter() - start
+    if parsed is not None:
+        update_date, df, deaths = parsed
+    elif chunksize:
+        start = perf_counter()
+        update_date, df, deaths = read_workbook_chunked(s, chunksize)
+        last_timings['parse'] = perf_counter() - start
+    else:
+        start = perf_counter()
+        update_date, df, deaths = read_workbook(s)
+        last_timings['parse'] = perf_counter() - start
+
+        start = perf_counter()
+        df = filter_cases(df)
+
+        # Most recent first; dates are formatted when a table page is rendered
+        deaths = deaths.sort_values('date_death_report', ascending=False)
+        deaths = filter_deaths(deaths)
+        last_timings['filter'] = perf_counter() - start
+
+        # Clean age group data
+        start = perf_counter()
+        df, case_hashes = clean_rows(df, previous and (previous[0], previous[2]))
+        deaths, death_hashes = clean_rows(deaths, previous and (previous[1], previous[3]))
+        last_source['row_hashes'] = (case_hashes, death_hashes)
+        df = compact_frame(df)
+        deaths = compact_frame(deaths)
+        last_timings['age_groups'] = perf_counter() - start
+
+    return update_date, df, deaths
+
+
+def get_covid_data(covid_case_url, method_='url', previous=None, chunksize=ingest_chunksize, workers=ingest_workers,
+                   current_key=None, current_path=None):
+    ''' Returns cleaned cases, deaths and the update date.
+    current_key: content hash of the workbook the caller already has; returns None if the workbook is the same.
+    current_path: the file the caller's workbook was read from; returns None without hashing it if the server
+    confirms that file is still current.
+    previous: (df, deaths, case row hashes, death row hashes) from an earlier call; rows unchanged since are not
+    grouped again. The row hashes of this call are left in last_source['row_hashes'].
+    chunksize: stream the sheets this many rows at a time instead (previous is not used then).
+    workers: parse and clean in this many processes instead (previous and chunksize are not used then), unless the
+    workbook leaves out the cell references that splitting it relies on.'''
+    last_timings.clear()
+    last_source.clear()
+    start = perf_counter()
+    changed = True
+    if method_ == 'url':
+        from fetch import fetch_first
+        try:
+            # Race the primary and backup exports; the backup only wins if the primary fails or lags
+            s, url, changed = fetch_first([covid_case_url, backup_url])
+            filesource_caveat = '' if url == covid_case_url else ' [cached].'
+        except Exception as e:
+            print(f'Download failed, using {local_path}: {e}')
+            s = local_path
+            filesource_caveat = ' [cached]'
+    else:
+        s = local_path
+        filesource_caveat = ' [cached]'
+    last_timings['download'] = perf_counter() - start
+    last_source['fallback'] = method_ == 'url' and s == local_path
+    last_source['path'] = s
+    if not changed and s == current_path:
+        # The server confirmed the copy already on disk, and the caller has it loaded
+        return None
+
+    # Reuse the cleaned frames if this exact workbook has been processed before
+    start = perf_counter()
+    key = content_hash(s)
+    last_source['key'] = key
+    if key == current_key:
+        last_timings['snapshot'] = perf_counter() - start
+        return None
+    snapshot = load_snapshot(key)
+    last_timings['snapshot'] = perf_counter() - start
+    if snapshot is not None:
+        df, deaths, update_date = snapshot
+        return df, deaths, update_date + filesource_caveat
+
+    # Rows are only reused when identical in every column, so this is the same as a clean of the workbook alone
+    update_date, df, deaths = process_workbook(s, previous, chunksize, workers)
+    save_snapshot(key, df, deaths, update_date)
+
+    return df, deaths, update_date + filesource_caveat
@@ -0,0 +1,162 @@
+import os
+import sys
+import threading
+from collections import Counter, deque
+from time import perf_counter
+
+# Upper bounds of the histogram buckets
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+row_buckets = (0, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Per-request sampling profiler, off unless this is set; then requests opt in with ?profile=1 or X-Profile: 1
+profiling_enabled = os.environ.get('COVID_PROFILING', '0') == '1'
+profile_interval = float(os.environ.get('COVID_PROFILE_INTERVAL', 0.001))
+
+_lock = threading.Lock()
+registry = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metric:
+    ''' A Prometheus counter, gauge or histogram, one series per label set.'''
+
+    def __init__(self, name, help_, kind, buckets=None):
+        self.name = name
+        self.help = help_
+        self.kind = kind
+        self.buckets = buckets
+        self._series = {}
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        with _lock:
+            self._series[tuple(sorted(labels.items()))] = value
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            # [count per bucket (made cumulative when rendered), sum, count]
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        with _lock:
+            if self.kind == 'histogram':
+                series = {labels: (list(v[0]), v[1], v[2]) for labels, v in self._series.items()}
+            else:
+                series = dict(self._series)
+        if self.kind != 'histogram':
+            for labels, value in series.items():
+                yield f'{self.name}{format_labels(labels)} {value}'
+            return
+        for labels, (counts, total, count) in series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield f'{self.name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}'
+            yield f'{self.name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}'
+            yield f'{self.name}_sum{format_labels(labels)} {total}'
+            yield f'{self.name}_count{format_labels(labels)} {count}'
+
+
+def counter(name, help_):
+    return Metric(name, help_, 'counter')
+
+
+def gauge(name, help_):
+    return Metric(name, help_, 'gauge')
+
+
+def histogram(name, help_, buckets=latency_buckets):
+    return Metric(name, help_, 'histogram', buckets)
+
+
+def render():
+    ''' All metrics in the Prometheus text format.'''
+    return '\n'.join(line for metric in registry for line in metric.lines()) + '\n'
+
+
+callback_seconds = histogram('covid_callback_seconds', 'Time to answer a Dash callback request')
+callback_bytes = histogram('covid_callback_response_bytes', 'Uncompressed size of a Dash callback response',
+                           size_buckets)
+callback_rows = histogram('covid_callback_rows', 'Rows of the case and death frames a callback scanned', row_buckets)
+callback_errors = counter('covid_callback_errors_total', 'Dash callback requests that failed')
+load_seconds = histogram('covid_load_stage_seconds', 'Time spent in each stage of get_covid_data')
+loads = counter('covid_data_loads_total', 'Data loads by whether the data changed')
+data_version = gauge('covid_data_version', 'Version of the data being served')
+data_rows = gauge('covid_data_rows', 'Rows in each frame being served')
+startup_seconds = gauge('covid_startup_seconds', 'Seconds from startup until the app could serve and until it had data')
+
+# Rows scanned while handling the current request
+_request = threading.local()
+
+
+def start_request():
+    _request.rows = 0
+
+
+def count_rows(n):
+    ''' Add to the rows scanned by the current callback.'''
+    _request.rows = getattr(_request, 'rows', 0) + n
+
+
+def request_rows():
+    return getattr(_request, 'rows', 0)
+
+
+class Sampler:
+    ''' Samples the stack of one thread every interval seconds. Stacks are folded as for flamegraph.pl.'''
+
+    def __init__(self, thread_id, interval=profile_interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self.started = perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = perf_counter() - self.started
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def folded(self):
+        return '\n'.join(f'{stack} {n}' for stack, n in self.stacks.most_common())
+
+
+# Latest profiles, newest last, served at /profiles
+profiles = deque(maxlen=20)
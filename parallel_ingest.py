@@ -0,0 +1,211 @@
+import io
+import multiprocessing
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from xml.etree.ElementTree import fromstring, iterparse
+from numpy import nan
+from format_data import compact_frame, concat_compact
+from get_covid_data_from_url import (keep_cols, keep_cols_death, date_cols, filter_cases, filter_deaths,
+                                     clean_frame, sheet_frame)
+
+# Reads the sheets straight from the xlsx archive so that each worker can take its own byte range of a
+# sheet's XML. openpyxl can only read a sheet from the top, so workers starting further down would each
+# parse everything above their rows first.
+main_ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+rel_id = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+row_tag, cell_tag, value_tag = f'{main_ns}row', f'{main_ns}c', f'{main_ns}v'
+text_tag, run_tag, inline_tag = f'{main_ns}t', f'{main_ns}r', f'{main_ns}is'
+row_start = re.compile(rb'<row[ >/]')
+header_row = 4
+block_size = 1 << 16
+
+
+class MissingReference(ValueError):
+    ''' A row or cell without its r attribute. It is optional, and without it rows can't be read from the middle
+    of a sheet.'''
+
+
+def reference(node):
+    ref = node.get('r')
+    if ref is None:
+        raise MissingReference(f'{node.tag} without a cell reference')
+    return ref
+
+
+def workbook_parts(z):
+    ''' Archive paths of the sheets by name and of the shared strings, and the date epoch.'''
+    workbook = fromstring(z.read('xl/workbook.xml'))
+    rels = fromstring(z.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in rels}
+    paths = {rel.get('Type').rsplit('/', 1)[-1]: rel.get('Target') for rel in rels}
+
+    def path(target):
+        # Targets are relative to xl/ unless absolute
+        return target.lstrip('/') if target.startswith('/') else 'xl/' + target
+
+    sheets = {sheet.get('name'): path(targets[sheet.get(rel_id)]) for sheet in workbook.iter(f'{main_ns}sheet')}
+    strings = path(paths['sharedStrings']) if 'sharedStrings' in paths else None
+    props = workbook.find(f'{main_ns}workbookPr')
+    date1904 = props is not None and props.get('date1904') in ['1', 'true']
+    return sheets, strings, datetime(1904, 1, 1) if date1904 else datetime(1899, 12, 30)
+
+
+def string_text(node):
+    ''' Text of a shared or inline string without its formatting, as openpyxl reads it.'''
+    snippets = [node.findtext(text_tag)] + [run.findtext(text_tag) for run in node.findall(run_tag)]
+    return ''.join(s for s in snippets if s is not None)
+
+
+def read_strings(z, path):
+    strings = []
+    if path is None:
+        return strings
+    with z.open(path) as f:
+        for _, node in iterparse(f):
+            if node.tag == f'{main_ns}si':
+                strings.append(string_text(node).replace('x005F_', ''))
+                node.clear()
+    return strings
+
+
+def cell_value(cell, strings):
+    ''' A cell's cached value, with whole numbers as ints like read_excel. Dates are left as serial numbers.'''
+    kind = cell.get('t', 'n')
+    if kind == 'inlineStr':
+        node = cell.find(inline_tag)
+        return None if node is None else string_text(node)
+    value = cell.findtext(value_tag) or None
+    if value is None:
+        return None
+    if kind == 'n':
+        number = float(value)
+        return int(number) if number.is_integer() else number
+    if kind == 's':
+        return strings[int(value)]
+    if kind == 'b':
+        return bool(int(value))
+    if kind == 'd':
+        return datetime.fromisoformat(value)
+    return value
+
+
+def row_cells(row, strings, letters=None):
+    ''' {column letter: value} of a <row>, only for letters if given.'''
+    cells = {}
+    for cell in row.iter(cell_tag):
+        letter = reference(cell).rstrip('0123456789')
+        if letters is None or letter in letters:
+            cells[letter] = cell_value(cell, strings)
+    return cells
+
+
+def sheet_head(z, path, strings):
+    ''' Cells of the rows up to the header, by row number.'''
+    rows = {}
+    with z.open(path) as f:
+        for _, node in iterparse(f):
+            if node.tag == row_tag:
+                rows[int(reference(node))] = row_cells(node, strings)
+                if int(reference(node)) >= header_row:
+                    break
+    return rows
+
+
+def part_xml(z, path, lo, hi):
+    ''' The opening <worksheet> tag and the <row> elements of a sheet's XML that start between bytes lo and hi.
+    Each row starts in exactly one of a set of adjoining ranges, so the parts of a sheet never overlap.'''
+    with z.open(path) as f:
+        root = re.search(rb'<worksheet\b[^>]*>', f.read(block_size)).group()
+        f.seek(lo)
+        data = f.read(hi - lo)
+        first = row_start.search(data)
+        if first is None:
+            return root, b''
+        # The last row ends where the next range's first row starts, or at the end of the sheet data
+        searched = hi - lo
+        while True:
+            next_row = row_start.search(data, searched)
+            ends = [i for i in [next_row.start() if next_row else -1, data.find(b'</sheetData>', first.start())]
+                    if i != -1]
+            if ends:
+                return root, data[first.start():min(ends)]
+            block = f.read(block_size)
+            if not block:
+                return root, data[first.start():]
+            # A tag may straddle the blocks
+            searched = max(hi - lo, len(data) - 16)
+            data += block
+
+
+def row_values(cells, letters, dates, epoch):
+    ''' Values of the wanted cells of a row, in order, as iter_sheet gives them: blanks are NaN and
+    serial numbers in date columns are datetimes.'''
+    values = []
+    for letter, is_date in zip(letters, dates):
+        value = cells.get(letter)
+        if value is None:
+            value = nan
+        elif is_date and isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = epoch + timedelta(days=value)
+        values.append(value)
+    return tuple(values)
+
+
+def parse_part(path, sheet, columns, filter_, part, parts):
+    ''' Read, filter, clean and compact the rows in one of parts equal byte ranges of a sheet.
+    Runs in a worker process. Returns the update date (from the sheet's first cell) and the frame, or None
+    if the range holds no rows.'''
+    with zipfile.ZipFile(path) as z:
+        sheets, strings_path, epoch = workbook_parts(z)
+        strings = read_strings(z, strings_path)
+        head = sheet_head(z, sheets[sheet], strings)
+        size = z.getinfo(sheets[sheet]).file_size
+        root, xml = part_xml(z, sheets[sheet], size * part // parts, size * (part + 1) // parts)
+    update_date = str(head.get(1, {}).get('A'))[13:]
+
+    # Column letters of the wanted columns, by their names in the header row (first one if repeated)
+    letters = {}
+    for letter, name in head.get(header_row, {}).items():
+        letters.setdefault(name, letter)
+    letters = [letters[col] for col in columns]
+    dates = [col in date_cols for col in columns]
+
+    chunk = []
+    for _, node in iterparse(io.BytesIO(root + b'<sheetData>' + xml + b'</sheetData></worksheet>')):
+        if node.tag != row_tag:
+            continue
+        if int(reference(node)) > header_row:
+            values = row_values(row_cells(node, strings, letters), letters, dates, epoch)
+            if not all(v is nan for v in values):
+                chunk.append(values)
+        node.clear()
+    if not chunk:
+        return update_date, None
+    return update_date, compact_frame(clean_frame(filter_(sheet_frame(chunk, columns))))
+
+
+def sort_filter_deaths(deaths):
+    # Most recent first, sorted before filtering like process_workbook so that ties come out in the same order
+    return filter_deaths(deaths.sort_values('date_death_report', ascending=False))
+
+
+def read_workbook_parallel(s, workers):
+    ''' Parse and clean the Mortality sheet and workers parts of the Cases sheet in a process pool.
+    Parts are joined in sheet order, so the frames are the same for any number of workers.
+    Returns None if the sheets leave out cell references.'''
+    # Forking while the app's other threads hold locks could leave a worker stuck on one of them
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+        deaths = pool.submit(parse_part, s, 'Mortality', keep_cols_death, sort_filter_deaths, 0, 1)
+        cases = [pool.submit(parse_part, s, 'Cases', keep_cols, filter_cases, part, workers)
+                 for part in range(workers)]
+        try:
+            cases = [future.result() for future in cases]
+            deaths = deaths.result()[1]
+        except MissingReference as e:
+            print(f'Cannot split the workbook ({e}), reading it whole')
+            return None
+    update_date = cases[0][0]
+    df = concat_compact([frame for _, frame in cases if frame is not None])
+    return update_date, df, deaths
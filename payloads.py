@@ -0,0 +1,88 @@
+import gzip
+import json
+import threading
+import plotly
+
+
+class PayloadCache:
+    ''' Callback outputs rendered once per data version and kept as gzipped JSON.
+    Each payload is registered with the argument tuples to render ahead of the first request. Only those are kept;
+    any other arguments are rendered on every request, so clients can't grow the cache.'''
+
+    def __init__(self, get_data):
+        self._get_data = get_data
+        self._renderers = {}
+        self._payloads = {}
+        # Keys of the registered arguments for the current version, the only ones stored
+        self._keys = set()
+        self._version = None
+        self._lock = threading.Lock()
+        self.raw_bytes = 0
+
+    def register(self, name, render, prerender_args):
+        ''' render(data, *args) returns the outputs; prerender_args(data) lists the args to render up front.'''
+        self._renderers[name] = (render, prerender_args)
+
+    def get(self, name, *args):
+        ''' Gzipped JSON of one payload for the current data version.'''
+        data = self._get_data()
+        if self._sync(data):
+            # First request on new data: render the rest before anyone asks for it
+            self.start_prerender()
+        key = (name, json.dumps(args))
+        with self._lock:
+            payload = self._payloads.get(key)
+        if payload is not None:
+            return payload
+
+        # Same encoder Dash uses, so the client gets exactly what the callback would have sent
+        raw = json.dumps(self._renderers[name][0](data, *args), cls=plotly.utils.PlotlyJSONEncoder).encode()
+        payload = gzip.compress(raw, compresslevel=6)
+        with self._lock:
+            if data.version == self._version and key in self._keys:
+                self._payloads[key] = payload
+                self.raw_bytes += len(raw)
+        return payload
+
+    def decoded(self, name, *args):
+        ''' A payload as plain lists and dicts, ready for a callback to return.'''
+        return json.loads(gzip.decompress(self.get(name, *args)))
+
+    def _sync(self, data):
+        ''' Drop payloads of older data. Returns True if data is a version not seen before.'''
+        with self._lock:
+            if data.version == self._version:
+                return False
+        keys = {(name, json.dumps(list(args))) for name, (render, prerender_args) in self._renderers.items()
+                for args in prerender_args(data)}
+        with self._lock:
+            if data.version == self._version:
+                return False
+            self._payloads.clear()
+            self._keys = keys
+            self._version = data.version
+            self.raw_bytes = 0
+            return True
+
+    def prerender(self):
+        data = self._get_data()
+        self._sync(data)
+        for name, (render, prerender_args) in self._renderers.items():
+            for args in prerender_args(data):
+                self.get(name, *args)
+
+    def start_prerender(self):
+        ''' Render every registered payload in the background.'''
+        thread = threading.Thread(target=self.prerender, name='payload-prerender', daemon=True)
+        thread.start()
+        return thread
+
+    def clear(self):
+        with self._lock:
+            self._payloads.clear()
+            self.raw_bytes = 0
+
+    def info(self):
+        with self._lock:
+            return {'payloads': len(self._payloads), 'data_version': self._version, 'raw_bytes': self.raw_bytes,
+                    'gzip_bytes': sum(len(payload) for payload in self._payloads.values())}
@@ -0,0 +1,153 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+import pyarrow as pa
+from data_store import DataStore, refresh_interval
+
+# One worker (the leader) fetches the workbook and publishes the frames as uncompressed Arrow files here.
+# The other workers memory-map them, so the column buffers live once in the page cache.
+shared_dir = r'Data/shared'
+pointer_path = os.path.join(shared_dir, 'current')
+lock_path = os.path.join(shared_dir, 'leader.lock')
+
+# Seconds between checks for a newer published version
+poll_interval = int(os.environ.get('COVID_SHARED_POLL', 5))
+# Seconds a worker waits at boot for the leader's first publish before loading on its own
+attach_timeout = int(os.environ.get('COVID_SHARED_TIMEOUT', 120))
+
+frame_names = ['df', 'deaths', 'case_text', 'death_text']
+
+
+def publish(frames, version, key, update_date):
+    ''' Write a data version's frames (by frame_names) and point the other workers at them.'''
+    name = f'{version}-{key}'
+    path = os.path.join(shared_dir, name)
+    # Never rewrite a published version in place: other workers have its files mapped
+    if not os.path.isdir(path):
+        tmp_path = f'{path}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for frame_name in frame_names:
+            table = pa.Table.from_pandas(frames[frame_name], preserve_index=False)
+            with pa.OSFile(os.path.join(tmp_path, f'{frame_name}.arrow'), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': version, 'key': key, 'update_date': update_date}, f)
+        os.rename(tmp_path, path)
+
+    # Atomic switch: workers read either the old or the new name, never half of one
+    tmp_pointer = f'{pointer_path}.tmp'
+    with open(tmp_pointer, 'w') as f:
+        f.write(name)
+    os.replace(tmp_pointer, pointer_path)
+
+    # Unlinking is safe for workers still mapping an older version
+    for old in os.listdir(shared_dir):
+        if old != name and os.path.isdir(os.path.join(shared_dir, old)):
+            shutil.rmtree(os.path.join(shared_dir, old), ignore_errors=True)
+
+
+def published_name():
+    try:
+        with open(pointer_path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def attach(name):
+    ''' Memory-map a published version. Returns (frames dict, meta).'''
+    path = os.path.join(shared_dir, name)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    frames = {}
+    for frame_name in frame_names:
+        source = pa.memory_map(os.path.join(path, f'{frame_name}.arrow'), 'r')
+        # split_blocks lets numeric columns stay views onto the mapped file instead of being consolidated
+        frames[frame_name] = pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+    return frames, meta
+
+
+class SharedDataStore(DataStore):
+    ''' DataStore whose data is loaded by one worker and shared with the others through Data/shared.'''
+
+    def __init__(self):
+        super().__init__()
+        os.makedirs(shared_dir, exist_ok=True)
+        self._lock_file = open(lock_path, 'a')
+        self._leader = False
+        self._attached = None
+
+    def is_leader(self):
+        ''' Take the leader lock if nobody holds it. It is released when the process exits.'''
+        if not self._leader:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self._leader = True
+            except OSError:
+                pass
+        return self._leader
+
+    def load(self, method_='url'):
+        if self.is_leader():
+            if self._data is None:
+                # Taking over from an earlier leader: start from what it published and keep its numbering
+                self.attach_latest()
+            with self._lock:
+                fetched = self._fetch(method_)
+                current = self._data
+                if fetched is not None:
+                    df, deaths, case_text, death_text, update_date, key = fetched
+                    frames = dict(zip(frame_names, [df, deaths, case_text, death_text]))
+                    publish(frames, 1 if current is None else current.version + 1, key, update_date)
+                elif current is not None and published_name() is None:
+                    publish({name: getattr(current, name) for name in frame_names}, current.version, self._key,
+                            current.update_date)
+            # Swap in the published files, so the leader's copy is the shared mapping too and is only built once
+            self.attach_latest()
+            return fetched is not None
+
+        # Follower: wait for the leader's first publish, then attach
+        waited = 0
+        while published_name() is None and waited < attach_timeout and self._data is None:
+            self._stop.wait(1)
+            waited += 1
+        if published_name() is None:
+            return super().load('cached') if self._data is None else False
+        return self.attach_latest()
+
+    def attach_latest(self):
+        ''' Swap in the published version if it is newer than ours. Returns True if it was.'''
+        name = published_name()
+        if name is None or name == self._attached:
+            return False
+        with self._lock:
+            frames, meta = attach(name)
+            self.swap(frames['df'], frames['deaths'], frames['case_text'], frames['death_text'],
+                      meta['update_date'], meta['key'], version=meta['version'])
+            self._attached = name
+        return True
+
+    def start_refresher(self, interval=refresh_interval):
+        thread = threading.Thread(target=self._shared_loop, args=(interval,), name='data-refresher', daemon=True)
+        thread.start()
+
+    def _shared_loop(self, interval):
+        since_fetch = 0
+        while not self._stop.wait(poll_interval):
+            since_fetch += poll_interval
+            try:
+                if self.is_leader():
+                    # Leader (possibly just taken over from a recycled worker) fetches on the normal schedule
+                    if interval > 0 and since_fetch >= interval:
+                        since_fetch = 0
+                        if self.load():
+                            print(f'Data refreshed and published: {self._data.update_date}')
+                elif self.attach_latest():
+                    print(f'Attached to shared data: {self._data.update_date}')
+            except Exception as e:
+                # Keep serving the current data and try again next time
+                print(f'Shared data refresh failed: {e}')
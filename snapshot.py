@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import shutil
+import pandas as pd
+
+try:
+    import pyarrow  # Feather backend; snapshots are skipped without it
+except ImportError:
+    pyarrow = None
+
+snapshot_dir = r'Data/snapshots'
+
+# Bump whenever the cleaned frames change shape so older snapshots are ignored
+SNAPSHOT_VERSION = 3
+
+
+def content_hash(s):
+    ''' Hash the raw workbook bytes of a BytesIO or a file path.'''
+    if hasattr(s, 'getvalue'):
+        return hashlib.sha1(s.getvalue()).hexdigest()
+    sha = hashlib.sha1()
+    with open(s, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def snapshot_path(key):
+    return os.path.join(snapshot_dir, f'v{SNAPSHOT_VERSION}-{key}')
+
+
+def load_snapshot(key):
+    ''' Return (df, deaths, update_date) for a workbook hash, or None if there is no usable snapshot.'''
+    path = snapshot_path(key)
+    if pyarrow is None or not os.path.isdir(path):
+        return None
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        df = pd.read_feather(os.path.join(path, 'cases.feather'))
+        deaths = pd.read_feather(os.path.join(path, 'deaths.feather'))
+    except Exception as e:
+        # Corrupt or half-written: drop it and let the caller reparse the xlsx
+        print(f'Discarding snapshot {path}: {e}')
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    return df, deaths, meta['update_date']
+
+
+def save_snapshot(key, df, deaths, update_date):
+    ''' Write the cleaned frames for a workbook hash and remove snapshots of older workbooks.'''
+    if pyarrow is None:
+        return
+    path = snapshot_path(key)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        df.reset_index(drop=True).to_feather(os.path.join(tmp_path, 'cases.feather'))
+        deaths.reset_index(drop=True).to_feather(os.path.join(tmp_path, 'deaths.feather'))
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'version': SNAPSHOT_VERSION, 'update_date': update_date}, f)
+        # Publish atomically so readers never see a partial snapshot
+        os.rename(tmp_path, path)
+    except Exception as e:
+        print(f'Could not write snapshot {path}: {e}')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+
+    # The upstream workbook changed, so older snapshots are stale
+    for name in os.listdir(snapshot_dir):
+        if '.tmp' not in name and os.path.join(snapshot_dir, name) != path:
+            shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
@@ -1,9 +1,331 @@
-import requests
-import eventlet
-
-eventlet.monkey_patch()
-try:
-    with eventlet.timeout.Timeout(0.00001):
-        response = requests.get('http://www.github.com/').content
-except:
-    print('ah')
\ No newline at end of file
+''' Checks the vectorized age grouping against the original loops and the server-side table paging, filtering
+and sorting, the export API on the bundled data, and exercises fetch.py against a local stand-in for the
+Google Sheets export.
+
+Run from the repo root:  python test.py
+'''
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+import flask
+import pandas as pd
+from numpy import nan
+from aggregates import selection_key
+from fetch import fetch_first, fetch_workbook, download_path
+from format_data import group_age, order_agegroups, order_dict
+from get_covid_data_from_url import read_workbook, local_path
+from viz_table import filter_frame, sort_frame, get_page
+
+
+# The row-by-row versions of group_age and order_agegroups
+def legacy_group_age(input_column):
+    output_column = []
+
+    def rangeify(z):
+        flr = int(round(z - 4.5, -1))
+        clg = flr + 9
+        return f'{flr}-{clg}'
+
+    for y in input_column:
+        try:
+            if type(y) == int:
+                if y < 20:
+                    output_column.append('<20')
+                else:
+                    output_column.append(rangeify(y))
+            elif '>' in y:
+                num = int(re.findall("[0-9]+", y)[0])
+                output_column.append(rangeify(num))
+            elif (y not in order_dict.keys()) or ('<' in y):
+                try:
+                    first_num = int(re.findall('[0-9]+', y)[0])
+                    if first_num < 20:
+                        output_column.append('<20')
+                    else:
+                        output_column.append(y)
+                except:
+                    output_column.append(y)
+                    pass
+            else:
+                output_column.append(y)
+        except:
+            output_column.append('')
+    return output_column
+
+
+def legacy_order_agegroups(input_column):
+    output_column = []
+    for i in input_column:
+        try:
+            output_column.append(order_dict[i])
+        except:
+            output_column.append(nan)
+    return output_column
+
+
+# Everything that has turned up in the sheet's age columns, plus edge cases around the buckets
+odd_ages = (list(order_dict) +
+            ['10-19', '<10', '<18', '<1', '<20', '>70', '>65', '>50', '>80', '>5', '>0', '>', '> 100',
+             '2 months', 'Not reported', 'not reported', '80+', '90s', '', ' ', '0-9', '60-69 ', 'N/A',
+             nan, None, 2.5, 80.0, True, False, datetime(2020, 10, 19), pd.Timestamp('2020-03-01')] +
+            list(range(0, 130)))
+
+
+def check_age_groups(ages):
+    ages = pd.Series(ages, dtype=object)
+    grouped = group_age(ages)
+    assert grouped.tolist() == legacy_group_age(ages), 'group_age differs'
+    pd.testing.assert_series_equal(order_agegroups(grouped), pd.Series(legacy_order_agegroups(grouped)),
+                                   check_names=False, check_dtype=len(ages) > 0)
+
+
+def test_age_groups():
+    check_age_groups(odd_ages)
+    check_age_groups(odd_ages[::-1] * 3)
+    check_age_groups([])
+    check_age_groups(['Not Reported'])
+    check_age_groups([45, 81, 12])
+    update_date, df, deaths = read_workbook(local_path)
+    for ages in [df['age'], deaths['age']]:
+        check_age_groups(ages)
+    print('age groups: vectorized output matches the loops')
+
+
+def test_tables():
+    # additional_info is kept apart from the frame, on the same index, as in the Dataset
+    frame = pd.DataFrame({'provincial_case_id': [1, 2, 3, 4, 5],
+                          'age': ['20-29', '<20', '40-49', '20-29', ''],
+                          'date_report': pd.to_datetime(['2020-03-01', '2020-03-15', '2020-04-02', '2020-03-15',
+                                                         None])},
+                         index=[10, 11, 12, 13, 14])
+    text = pd.DataFrame({'additional_info': ['Travel to Italy', 'Close contact', nan, 'travel', 'Italy']},
+                        index=frame.index)
+    date_cols = ['date_report']
+
+    def ids(filter_query='', sort_by=None):
+        x = sort_frame(filter_frame(frame, filter_query, date_cols, text), sort_by, text)
+        return x['provincial_case_id'].tolist()
+
+    # Dates are compared as typed in the table, day first
+    assert ids('{date_report} >= 15-03-2020') == [2, 3, 4]
+    assert ids('{date_report} < 02-04-2020') == [1, 2, 4]
+    assert ids('{date_report} datestartswith 15-03') == [2, 4]
+    assert ids('{age} contains 20') == [1, 2, 4]
+    assert ids('{age} = "20-29"') == [1, 4]
+    assert ids('{provincial_case_id} > 3') == [4, 5]
+    assert ids('{additional_info} contains Italy') == [1, 5]
+    assert ids('{age} = 20-29 && {date_report} ge 10-03-2020') == [4]
+    # Unknown columns are ignored
+    assert ids('{nope} = 1') == [1, 2, 3, 4, 5]
+    assert ids(sort_by=[{'column_id': 'nope', 'direction': 'asc'}]) == [1, 2, 3, 4, 5]
+
+    assert ids(sort_by=[{'column_id': 'additional_info', 'direction': 'asc'}]) == [2, 5, 1, 4, 3]
+    assert ids(sort_by=[{'column_id': 'date_report', 'direction': 'desc'}]) == [3, 2, 4, 1, 5]
+
+    columns = ['provincial_case_id', 'date_report', 'additional_info']
+    records, page_count = get_page(frame, columns, 0, 2, date_cols, text)
+    assert page_count == 3 and records == [
+        {'provincial_case_id': 1, 'date_report': '01-03-2020', 'additional_info': 'Travel to Italy'},
+        {'provincial_case_id': 2, 'date_report': '15-03-2020', 'additional_info': 'Close contact'}]
+    assert get_page(frame, columns, 2, 2, date_cols, text)[0][0]['provincial_case_id'] == 5
+    # Past the end: no rows, same page count
+    assert get_page(frame, columns, 5, 2, date_cols, text) == ([], 3)
+    assert get_page(frame.iloc[:0], columns, 0, 2, date_cols, text) == ([], 1)
+    print('tables: paging, filtering and sorting')
+
+
+def test_export():
+    # The app on the bundled workbook, without refreshes
+    os.environ.update(COVID_DATA_SOURCE='cached', COVID_REFRESH_INTERVAL='0')
+    import pyarrow as pa
+    import covid_dash
+    import export_api
+    # Small chunks, so every export below spans several
+    export_api.export_chunk_rows = 100
+    client = covid_dash.server.test_client()
+    data = covid_dash.store.get()
+    cases, deaths = data.df.join(data.case_text), data.deaths.join(data.death_text)
+
+    def get(url):
+        response = client.get(url)
+        body = response.data
+        response.close()
+        return response, body
+
+    # CSV of a region between two dates
+    response, body = get('/api/export?province=Ontario&region=Toronto&start=2020-03-10&end=2020-03-20')
+    assert response.status_code == 200 and response.headers['X-Data-Version'] == str(data.version)
+    got = pd.read_csv(io.BytesIO(body))
+    expected = cases[(cases['province'] == 'Ontario') & (cases['health_region'] == 'Toronto') &
+                     (cases['date_report'] >= '2020-03-10') & (cases['date_report'] <= '2020-03-20')]
+    assert len(data.case_index.rows[selection_key('Ontario', 'Toronto')]) > export_api.export_chunk_rows
+    assert got.columns.tolist() == export_api.tables['cases'][4]
+    assert got['provincial_case_id'].tolist() == expected['provincial_case_id'].tolist()
+    assert got['date_report'].tolist() == expected['date_report'].dt.strftime('%Y-%m-%d').tolist()
+
+    # Arrow of a province's deaths, read back as the frame slice
+    response, body = get('/api/export?table=deaths&format=arrow&province=Ontario')
+    got = pa.ipc.open_stream(body).read_all().to_pandas()
+    expected = deaths[deaths['province'] == 'Ontario'][export_api.tables['deaths'][4]].reset_index(drop=True)
+    assert len(expected) > export_api.export_chunk_rows
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False, check_categorical=False)
+
+    # No rows: just the CSV header, or an Arrow stream with the schema and no batches
+    response, body = get('/api/export?province=Nowhere')
+    assert response.status_code == 200 and body == (','.join(export_api.tables['cases'][4]) + '\n').encode()
+    response, body = get('/api/export?province=Nowhere&format=arrow')
+    assert pa.ipc.open_stream(body).read_all().num_rows == 0
+
+    assert get('/api/export?table=nope')[0].status_code == 400
+    assert get('/api/export?start=not-a-date')[0].status_code == 400
+
+    # Every slot taken by an open download: 503 until one is closed
+    held = [client.get('/api/export') for _ in range(export_api.export_concurrency)]
+    response, body = get('/api/export')
+    assert response.status_code == 503 and response.headers['Retry-After']
+    for response in held:
+        response.close()
+    assert get('/api/export')[0].status_code == 200
+
+    # A failure before the download starts gives its slot back
+    def broken():
+        raise RuntimeError('no data')
+
+    app = flask.Flask('export-test')
+    app.logger.disabled = True
+    app.register_blueprint(export_api.export_blueprint(broken))
+    broken_client = app.test_client()
+    assert [broken_client.get('/api/export').status_code
+            for _ in range(export_api.export_concurrency + 1)] == [500] * (export_api.export_concurrency + 1)
+    print('export: csv, arrow, empty selections and busy slots')
+
+
+with open(local_path, 'rb') as f:
+    workbook = f.read()
+etag = '"v1"'
+# Range headers the stand-in was sent
+ranges = []
+
+
+class StandIn(BaseHTTPRequestHandler):
+    ''' /ok serves the workbook with an ETag, /slow trickles it, /fail errors and /html is not a workbook.
+    /late answers after a short pause and /cut drops the connection halfway unless asked for a range. Ranges are served if If-Range matches.'''
+
+    def do_GET(self):
+        if self.path == '/fail':
+            self.send_error(500)
+            return
+        if self.path == '/ok' and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if self.path == '/late':
+            time.sleep(0.3)
+        body = b'<html>Sign in</html>' if self.path == '/html' else workbook
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            ranges.append(self.headers['Range'])
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        body = body[start:]
+        if self.path == '/cut' and not start:
+            self.wfile.write(body[:len(body) // 2])
+            return
+        try:
+            if self.path == '/slow':
+                for i in range(0, len(body), 4096):
+                    self.wfile.write(body[i:i + 4096])
+                    time.sleep(0.05)
+            else:
+                self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def test_fetch():
+    server = Server(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    dest_dir = tempfile.mkdtemp()
+
+    try:
+        # The backup wins if the primary is still running after the grace period
+        start = time.perf_counter()
+        path, url, changed = fetch_first([f'{base}/slow', f'{base}/ok'], dest_dir, timeout=2, grace=0.5)
+        assert url == f'{base}/ok' and changed and 0.5 <= time.perf_counter() - start < 2
+        with open(path, 'rb') as f:
+            assert f.read() == workbook
+        print('slow primary: backup used')
+
+        # A healthy primary that is a little slower still wins
+        path, url, changed = fetch_first([f'{base}/late', f'{base}/ok'], dest_dir, timeout=2, grace=1)
+        assert url == f'{base}/late'
+        print('late primary: primary used')
+
+        # A failing primary doesn't wait for anything
+        path, url, changed = fetch_first([f'{base}/fail', f'{base}/html', f'{base}/ok'], dest_dir, timeout=2)
+        assert url == f'{base}/ok'
+        print('failing primary: backup used')
+
+        # Same ETag: 304 and the copy on disk is reused
+        path, changed = fetch_workbook(f'{base}/ok', dest_dir)
+        assert not changed and os.path.getsize(path) == len(workbook)
+        print('unchanged workbook: not downloaded again')
+
+        # A dropped connection leaves the partial file, and the next fetch asks only for the rest
+        try:
+            fetch_workbook(f'{base}/cut', dest_dir)
+            raise AssertionError('expected the download to fail')
+        except IOError:
+            pass
+        part_size = os.path.getsize(download_path(f'{base}/cut', dest_dir) + '.part')
+        assert 0 < part_size < len(workbook)
+        path, changed = fetch_workbook(f'{base}/cut', dest_dir)
+        assert changed and ranges == [f'bytes={part_size}-']
+        with open(path, 'rb') as f:
+            assert f.read() == workbook
+        print('interrupted download: resumed')
+
+        # Nothing usable within the timeout: give up on time and keep only the partial workbook to resume
+        start = time.perf_counter()
+        try:
+            fetch_first([f'{base}/fail', f'{base}/html', f'{base}/slow'], dest_dir, timeout=1)
+            raise AssertionError('expected IOError')
+        except IOError as e:
+            print(f'no workbook: {e}')
+        assert time.perf_counter() - start < 2
+        # The losing downloads above have hit their own deadlines by now
+        time.sleep(2)
+        parts = [name for name in os.listdir(dest_dir) if name.endswith('.part')]
+        assert parts == [os.path.basename(download_path(f'{base}/slow', dest_dir)) + '.part']
+    finally:
+        server.shutdown()
+        shutil.rmtree(dest_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    test_age_groups()
+    test_tables()
+    test_export()
+    test_fetch()
+    print('ok')
@@ -0,0 +1,114 @@
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from aggregates import all_provinces, all_regions, selection_key
+
+# Counts for every (province, region) selection on a continuous calendar, built once per data load.
+# Rows are selections (prov, region), including (prov, 'All Regions') and ('All Provinces', 'All Regions').
+#   daily:   counts per date, 0 where none
+#   weekly:  counts per week, labelled by its Sunday like report_week
+#   rolling: 7-day average ending on each date
+TimeSeries = namedtuple('TimeSeries', ['daily', 'weekly', 'rolling'])
+
+kinds = ['daily', 'weekly', 'rolling']
+
+
+def week_start(dates):
+    ''' The Sunday starting each date's week, the same as report_week.'''
+    dates = pd.DatetimeIndex(dates)
+    return dates - pd.to_timedelta((dates.weekday + 1) % 7, unit='D')
+
+
+def _selection_counts(fine):
+    ''' Roll counts indexed by (province, region) up to every selection.'''
+    total = fine.sum().to_frame((all_provinces, all_regions)).T
+    provinces = fine.groupby(level=0).sum()
+    provinces.index = [(prov, all_regions) for prov in provinces.index]
+    regions = fine[fine.index.get_level_values(1) != '']
+    out = pd.concat([total, provinces, regions], sort=False)
+    out.index = pd.MultiIndex.from_tuples(list(out.index))
+    return out
+
+
+def _pairs(frame):
+    ''' Code of each row's (province, region) and the pairs the codes stand for.
+    Missing geography is '' so those rows still count towards the broader totals.'''
+    codes, labels = [], []
+    for col in ['province', 'health_region']:
+        x = frame[col]
+        if hasattr(x, 'cat'):
+            # Factorizing a categorical only touches its codes
+            x = x if '' in x.cat.categories else x.cat.add_categories([''])
+        else:
+            x = x.astype(object)
+        code, label = pd.factorize(x.fillna(''))
+        codes.append(code)
+        labels.append(np.asarray(label, dtype=object))
+    pair, unique = pd.factorize(codes[0] * len(labels[1]) + codes[1])
+    pairs = pd.MultiIndex.from_arrays([labels[0][unique // len(labels[1])], labels[1][unique % len(labels[1])]])
+    return pair, pairs
+
+
+def _days(frame, id_col, date_col, first_day):
+    ''' Pair codes and day numbers (from first_day) of the rows counted, those with an id and a date.'''
+    pair, pairs = _pairs(frame)
+    counted = (frame[id_col].notna() & frame[date_col].notna()).values
+    day = (frame[date_col].values[counted] - np.datetime64(first_day)) // np.timedelta64(1, 'D')
+    return pair[counted], day, pairs
+
+
+def _daily(pair, day, pairs, dates):
+    ''' Counts per selection for each of dates, from rows' pair codes and day numbers (0 is dates[0]).'''
+    # One flat cell per (pair, day), counted in a single pass
+    counts = np.bincount(pair * len(dates) + day, minlength=len(pairs) * len(dates))
+    fine = pd.DataFrame(counts.reshape(len(pairs), len(dates)), index=pairs, columns=dates)
+    return _selection_counts(fine).astype('int32')
+
+
+def _weekly(daily):
+    return daily.groupby(week_start(daily.columns), axis=1).sum()
+
+
+def _rolling(daily):
+    # Days before the first report had no cases, so early windows are still divided by 7
+    return daily.T.rolling(7, min_periods=1).sum().T / 7
+
+
+def build_series(frame, id_col, date_col):
+    dates = frame[date_col].dropna()
+    if len(dates) == 0:
+        empty = pd.DataFrame(index=pd.MultiIndex.from_tuples([(all_provinces, all_regions)]))
+        return TimeSeries(empty, empty, empty)
+    pair, day, pairs = _days(frame, id_col, date_col, dates.min())
+    daily = _daily(pair, day, pairs, pd.date_range(dates.min(), dates.max()))
+    return TimeSeries(daily, _weekly(daily), _rolling(daily))
+
+
+def window(series, kind, start=None, end=None):
+    ''' Columns of one of the series between start and end (dates or None for open ended).
+    Weekly windows are whole weeks: the first and last weeks are counted in full, even the days outside
+    start and end.'''
+    table = getattr(series, kind)
+    if kind == 'weekly':
+        # Weeks are labelled by their Sunday, so a week is in if its Sunday is
+        start = start if start is None else week_start([start])[0]
+        end = end if end is None else week_start([end])[0]
+    return table.loc[:, start:end]
+
+
+def selection_window(series, kind, prov, region, start=None, end=None):
+    ''' One selection's counts in the window, as a Series by date.'''
+    table = window(series, kind, start, end)
+    key = selection_key(prov, region)
+    if key not in table.index:
+        return pd.Series(dtype='float64', index=pd.DatetimeIndex([]))
+    return table.loc[key]
+
+
+def province_window(series, kind, start=None, end=None):
+    ''' Every province's counts in the window, dates x provinces.'''
+    table = window(series, kind, start, end)
+    provinces = [key for key in table.index if key[1] == all_regions and key[0] not in [all_provinces, '']]
+    out = table.loc[provinces].T
+    out.columns = [prov for prov, region in provinces]
+    return out
@@ -1,12 +1,113 @@
 import dash_table
 import dash_html_components as html
 import dash_core_components as dcc
+import pandas as pd
 
 
-def generate_dashtable(dataframe, id_='filtered-datatable', page_size_val=10):
+def generate_dashtable(columns, id_='filtered-datatable', page_size_val=10, **kwargs):
+    ''' DataTable whose paging, sorting and filtering are done server side.'''
     return dash_table.DataTable(
             id=id_,
-            columns=[{"name": i, "id": i} for i in dataframe.columns],
+            columns=columns,
             page_current=0,
             page_size=page_size_val,
-            page_action='custom')
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='single',
+            sort_by=[],
+            filter_action='custom',
+            filter_query='',
+            **kwargs)
+
+
+# Same operator syntax as the DataTable filter row
+operators = [['ge ', '>='],
+             ['le ', '<='],
+             ['lt ', '<'],
+             ['gt ', '>'],
+             ['ne ', '!='],
+             ['eq ', '='],
+             ['contains '],
+             ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+    ''' e.g. "{age} = 20-29" -> ('age', 'eq', '20-29')'''
+    for operator_type in operators:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[0] if value_part else ''
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    value = value_part
+                return name, operator_type[0].strip(), value
+    return None, None, None
+
+
+def get_column(frame, col_name, text=None):
+    ''' A column of frame, or of its separately stored text columns (aligned on the index).'''
+    if col_name in frame.columns:
+        return frame[col_name]
+    if text is not None and col_name in text.columns:
+        return text[col_name].reindex(frame.index)
+    return None
+
+
+def filter_frame(frame, filter_query, date_cols=(), text=None):
+    ''' Apply a DataTable filter_query. Dates are typed as shown in the table (dd-mm-yyyy).'''
+    if not filter_query:
+        return frame
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, value = split_filter_part(filter_part)
+        col = get_column(frame, col_name, text)
+        if col is None:
+            continue
+
+        if operator in ('contains', 'datestartswith'):
+            if col_name in date_cols:
+                col = col.dt.strftime('%d-%m-%Y')
+            col = col.astype(str)
+            if operator == 'contains':
+                mask = col.str.contains(value, regex=False, na=False)
+            else:
+                mask = col.str.startswith(value, na=False)
+        else:
+            if col_name in date_cols:
+                value = pd.to_datetime(value, dayfirst=True, errors='coerce')
+            elif pd.api.types.is_numeric_dtype(col):
+                value = pd.to_numeric(value, errors='coerce')
+            # Operator names match the Series comparison methods (ge, le, lt, gt, ne, eq)
+            try:
+                mask = getattr(col, operator)(value)
+            except TypeError:
+                # Mixed text and missing values, compare as strings
+                mask = getattr(col.astype(str), operator)(str(value))
+        frame = frame.loc[mask]
+    return frame
+
+
+def sort_frame(frame, sort_by, text=None):
+    ''' Apply a DataTable sort_by list.'''
+    sort_by = [i for i in sort_by or [] if get_column(frame, i['column_id'], text) is not None]
+    if not sort_by:
+        return frame
+    keys = pd.DataFrame({i['column_id']: get_column(frame, i['column_id'], text) for i in sort_by})
+    keys = keys.sort_values([i['column_id'] for i in sort_by],
+                            ascending=[i['direction'] == 'asc' for i in sort_by])
+    return frame.loc[keys.index]
+
+
+def get_page(frame, columns, page_current, page_size, date_cols=(), text=None):
+    ''' Records for the visible page only and the total page count.'''
+    page_count = max(1, -(-len(frame) // page_size))
+    start = (page_current or 0) * page_size
+    page = frame.iloc[start:start + page_size]
+    page = pd.DataFrame({col: get_column(page, col, text) for col in columns})
+    for col in date_cols:
+        page[col] = page[col].dt.strftime('%d-%m-%Y')
+    return page.to_dict('records'), page_count